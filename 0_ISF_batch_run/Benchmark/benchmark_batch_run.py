@@ -0,0 +1,174 @@
+#!/usr/local/bin/python3.5
+
+# Note: this script benchmarks ISF_batch_run.py on synthetic lists of seeds,
+# with fake_isf_main.py standing in for ISF. It measures the throughput of
+# the batch runner, the overhead of its scheduling (wall time of the batch
+# minus the wall time of its instances divided by the number of slots) and
+# the cost of logging the output of the instances (difference with a run
+# whose instances are silent).
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+
+def create_seeds(seed_dir, nb_seeds, nb_sequences):
+    if os.path.exists(seed_dir):
+        shutil.rmtree(seed_dir)
+    os.makedirs(seed_dir)
+    seed_paths = list()
+    for i in range(0, nb_seeds):
+        seed_path = os.path.join(seed_dir, "seed_%05d.faa" % i)
+        with open(seed_path, mode='w') as f:
+            for j in range(0, nb_sequences):
+                f.write(">seed_%05d_%d [Fakeus isfii]\nMKVLAAGIVGLLLAVSAQA\n" % (i, j))
+        f.close()
+        seed_paths.append(seed_path)
+    return seed_paths
+
+
+def write_list_of_paths(paths, list_path):
+    with open(list_path, mode='w') as f:
+        for path in paths:
+            f.write("%s\n" % path)
+    f.close()
+
+
+def run_batch(args, work_dir, list_fa, list_db, env, label):
+    output_dir = os.path.join(work_dir, label)
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    cmd = [sys.executable, args.batch_run_path,
+           '--list_of_fasta_paths', list_fa, '--list_of_db_paths', list_db,
+           '--output_dir', output_dir, '--ISF_path', args.fake_isf_path,
+           '--python', sys.executable, '--parallel_jobs', str(args.jobs),
+           '-th', str(args.th), '-mkdb_', 'true', '--rerun_all'] + args.runner_args
+    start_time = time.time()
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    wall_time = time.time() - start_time
+    if result.returncode != 0:
+        sys.exit("ISF_batch_run.py failed:\n%s" % result.stderr.decode('utf-8', errors='replace'))
+    with open(os.path.join(output_dir, "ISF_batch_report.json"), mode='r') as f:
+        report = json.load(f)
+    f.close()
+    # total wall time of the instances of ISF
+    jobs_wall_time = 0.0
+    with open(os.path.join(output_dir, "ISF_batch_jobs.tsv"), mode='r') as f:
+        columns = next(f).lstrip('#').rstrip('\n').split('\t')
+        for row in f:
+            metrics = dict(zip(columns, row.rstrip('\n').split('\t')))
+            if metrics['wall_time_s']:
+                jobs_wall_time += float(metrics['wall_time_s'])
+    f.close()
+    log_size = os.path.getsize(os.path.join(output_dir, "ISF_batch.log"))
+    for fa_name in os.listdir(output_dir):
+        isf_log = os.path.join(output_dir, fa_name, "ISF.log")
+        if os.path.isfile(isf_log):
+            log_size += os.path.getsize(isf_log)
+    return [wall_time, report, jobs_wall_time, log_size]
+
+
+parser = argparse.ArgumentParser(description='This script benchmarks ISF_batch_run.py with a fake ISF')
+parser.add_argument('-o', '--output_dir', dest='output_dir', type=str, required=True,
+                    help='specify the path to the directory where the synthetic batches are run')
+parser.add_argument('--sizes', dest='sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                    help='specify the numbers of seeds of the synthetic batches (10 100 1000 10000 by default)')
+parser.add_argument('--seed_sequences', dest='seed_sequences', type=int, default=1,
+                    help='specify the number of sequences per seed (1 by default)')
+parser.add_argument('--parallel_jobs', dest='jobs', type=int, default=4,
+                    help='specify the number of instances of ISF run concurrently (4 by default)')
+parser.add_argument('-th', dest='th', type=int, default=4,
+                    help='specify the global thread budget of the batches (4 by default)')
+parser.add_argument('--sleep', dest='sleep', type=float, default=0.0,
+                    help='specify the seconds each fake search sleeps (0 by default)')
+parser.add_argument('--cpu', dest='cpu', type=float, default=0.0,
+                    help='specify the seconds of CPU each fake search burns (0 by default)')
+parser.add_argument('--stdout_lines', dest='stdout_lines', type=int, default=1000,
+                    help='specify the number of lines each fake search writes on stdout (1000 by default)')
+parser.add_argument('--stderr_lines', dest='stderr_lines', type=int, default=10,
+                    help='specify the number of lines each fake search writes on stderr (10 by default)')
+parser.add_argument('--failure_rate', dest='failure_rate', type=float, default=0.0,
+                    help='specify the fraction of the seeds whose fake search fails (0 by default)')
+parser.add_argument('--runner_args', dest='runner_args', type=str, nargs=argparse.REMAINDER, default=[],
+                    help='additional arguments passed as is to ISF_batch_run.py (must come last)')
+args = parser.parse_args()
+
+##########################################
+# SETUP ##################################
+##########################################
+# get the directory of the executing script
+script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+args.batch_run_path = os.path.join(script_dir, '..', 'ISF_batch_run.py')
+args.fake_isf_path = os.path.join(script_dir, 'fake_isf_main.py')
+args.output_dir = os.path.abspath(args.output_dir)
+os.makedirs(args.output_dir, exist_ok=True)
+
+# fake target database
+db_path = os.path.join(args.output_dir, "fake_db.faa")
+with open(db_path, mode='w') as f:
+    f.write(">target_0 [Fakeus isfii]\nMKVLAAGIVGLLLAVSAQA\n")
+f.close()
+list_db = os.path.join(args.output_dir, "list_of_db_paths.txt")
+write_list_of_paths([db_path], list_db)
+
+# behaviour of the fake ISF
+env = dict(os.environ)
+env['FAKE_ISF_SLEEP'] = str(args.sleep)
+env['FAKE_ISF_CPU'] = str(args.cpu)
+env['FAKE_ISF_STDOUT_LINES'] = str(args.stdout_lines)
+env['FAKE_ISF_STDERR_LINES'] = str(args.stderr_lines)
+env['FAKE_ISF_FAILURE_RATE'] = str(args.failure_rate)
+silent_env = dict(env)
+silent_env['FAKE_ISF_STDOUT_LINES'] = '0'
+silent_env['FAKE_ISF_STDERR_LINES'] = '0'
+
+##########################################
+# BENCHMARK ##############################
+##########################################
+columns = ['nb_seeds', 'wall_time_s', 'seeds_per_s', 'nb_failed', 'scheduler_overhead_s',
+           'overhead_per_seed_ms', 'log_lines', 'log_bytes', 'log_cost_s', 'log_cost_per_line_us']
+results = list()
+print("\t".join(columns))
+for nb_seeds in args.sizes:
+    work_dir = os.path.join(args.output_dir, "batch_%d" % nb_seeds)
+    os.makedirs(work_dir, exist_ok=True)
+    seed_paths = create_seeds(os.path.join(work_dir, "seeds"), nb_seeds, args.seed_sequences)
+    list_fa = os.path.join(work_dir, "list_of_fasta_paths.txt")
+    write_list_of_paths(seed_paths, list_fa)
+
+    wall_time, report, jobs_wall_time, log_bytes = \
+        run_batch(args, work_dir, list_fa, list_db, env, "verbose")
+    # wall time of the batch if the slots had been kept busy all along
+    nb_jobs = max(1, min(args.jobs, args.th, nb_seeds))
+    overhead = wall_time - jobs_wall_time / nb_jobs
+
+    log_lines = nb_seeds * (args.stdout_lines + args.stderr_lines)
+    if log_lines:
+        silent_wall_time = run_batch(args, work_dir, list_fa, list_db, silent_env, "silent")[0]
+        log_cost = wall_time - silent_wall_time
+    else:
+        log_cost = 0.0
+
+    result = {'nb_seeds': nb_seeds, 'wall_time_s': round(wall_time, 3),
+              'seeds_per_s': round(nb_seeds / wall_time, 2), 'nb_failed': report['nb_failed'],
+              'scheduler_overhead_s': round(overhead, 3),
+              'overhead_per_seed_ms': round(overhead / nb_seeds * 1000, 3),
+              'log_lines': log_lines, 'log_bytes': log_bytes, 'log_cost_s': round(log_cost, 3),
+              'log_cost_per_line_us': round(log_cost / log_lines * 10**6, 3) if log_lines else 0}
+    results.append(result)
+    print("\t".join(str(result[c]) for c in columns))
+    sys.stdout.flush()
+
+##########################################
+# OUTPUT #################################
+##########################################
+with open(os.path.join(args.output_dir, "benchmark_batch_run.tsv"), mode='w') as f:
+    f.write("#%s\n" % "\t".join(columns))
+    for result in results:
+        f.write("%s\n" % "\t".join(str(result[c]) for c in columns))
+f.close()
@@ -0,0 +1,81 @@
+#!/usr/local/bin/python3.5
+
+# Note: this script is a stand-in for isf_main.py used to benchmark
+# ISF_batch_run.py without BLAST databases. It accepts the command line
+# of ISF and its behaviour is set through environment variables, since
+# the batch runner builds the command line itself:
+#   FAKE_ISF_SLEEP         seconds spent sleeping (0 by default)
+#   FAKE_ISF_CPU           seconds spent burning CPU (0 by default)
+#   FAKE_ISF_STDOUT_LINES  number of lines written on stdout (10 by default)
+#   FAKE_ISF_STDERR_LINES  number of lines written on stderr (0 by default)
+#   FAKE_ISF_ITERATIONS    number of iterations reported (3 by default)
+#   FAKE_ISF_EXIT_CODE     exit status of failing instances (1 by default)
+#   FAKE_ISF_FAILURE_RATE  fraction of the seeds that fail (0 by default)
+#   FAKE_ISF_NB_FOUND      number of sequences "retrieved" (10 by default)
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+
+def env(name, default, cast):
+    return cast(os.environ.get(name, default))
+
+
+def burn_cpu(seconds):
+    end_time = time.process_time() + seconds
+    x = 0
+    while time.process_time() < end_time:
+        for i in range(0, 10000):
+            x += i * i
+    return x
+
+
+def is_failing(query, failure_rate):
+    # the same seeds fail from one run to the next
+    digest = hashlib.md5(os.path.basename(query).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / float(16**8) < failure_rate
+
+
+def write_outputs(query, output_dir, nb_found):
+    with open(query, mode='r') as f:
+        seeds = f.read()
+    f.close()
+    found = "".join(">found_%d [Fakeus isfii]\nMKVLAAGIVGLLLA\n" % k for k in range(0, nb_found))
+    with open(os.path.join(output_dir, "sequence_found.faa"), mode='w') as f:
+        f.write(found)
+    f.close()
+    with open(os.path.join(output_dir, "sequence_found_and_bases.faa"), mode='w') as f:
+        f.write(seeds + found)
+    f.close()
+
+
+parser = argparse.ArgumentParser(description='Stand-in for isf_main.py used to benchmark ISF_batch_run.py')
+parser.add_argument('-query', type=str, required=True)
+parser.add_argument('-db_fa', type=str)
+parser.add_argument('-th', type=int, default=1)
+parser.add_argument('-wd', type=str, required=True)
+args, other_args = parser.parse_known_args()
+
+nb_stdout_lines = env('FAKE_ISF_STDOUT_LINES', 10, int)
+nb_stderr_lines = env('FAKE_ISF_STDERR_LINES', 0, int)
+nb_iterations = max(1, env('FAKE_ISF_ITERATIONS', 3, int))
+
+for k in range(0, nb_stdout_lines):
+    sys.stdout.write("iteration %d: %d sequences in the family\n" %
+                     (k * nb_iterations // max(nb_stdout_lines, 1) + 1, k))
+for k in range(0, nb_stderr_lines):
+    sys.stderr.write("warning %d: this is a fake warning\n" % k)
+sys.stdout.flush()
+sys.stderr.flush()
+
+time.sleep(env('FAKE_ISF_SLEEP', 0, float))
+burn_cpu(env('FAKE_ISF_CPU', 0, float))
+
+if is_failing(args.query, env('FAKE_ISF_FAILURE_RATE', 0, float)):
+    sys.stderr.write("fake failure of the search\n")
+    sys.exit(env('FAKE_ISF_EXIT_CODE', 1, int))
+
+write_outputs(args.query, args.wd, env('FAKE_ISF_NB_FOUND', 10, int))
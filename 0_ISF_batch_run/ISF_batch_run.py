@@ -2,12 +2,35 @@
 
 
 import argparse
+import asyncio
+import collections
+import json
 import logging
 import os
+import re
+import shutil
+import signal
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 import sys
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import instrumentation
+import pipeline_utils
+
+
+# Number of log records held in memory before being written to ISF.log
+LOG_BUFFER_CAPACITY = 512
+# Number of stderr lines of ISF reported in the batch log when it fails
+STDERR_TAIL_LENGTH = 20
+# Progress lines of ISF from which the number of iterations is taken
+ITERATION_PATTERN = re.compile(r'\b(?:iteration|run)\s*(?:n°|#|:)?\s*(\d+)', re.IGNORECASE)
+# Columns of the per-job resource accounting table
+JOB_METRICS = ['family', 'fasta', 'db', 'status', 'exit_status', 'threads', 'wall_time_s',
+               'user_cpu_s', 'sys_cpu_s', 'max_rss_kb', 'read_bytes', 'written_bytes',
+               'nb_iterations', 'nb_sequences_retrieved']
 
 
 def read_list_of_paths(path_list):
@@ -21,16 +44,55 @@ def read_list_of_paths(path_list):
     return in_files
 
 
-def create_logger(name, filename):
-    try:
-        os.remove(filename)
-    except OSError:
-        pass
+class BatchedFileHandler(logging.FileHandler):
+    # File handler that formats the records in memory and writes them to
+    # the file by batches rather than with one write per record
+    def __init__(self, filename, capacity=LOG_BUFFER_CAPACITY):
+        logging.FileHandler.__init__(self, filename, mode="a+")
+        self.capacity = capacity
+        self.buffer = list()
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+        if len(self.buffer) >= self.capacity or record.levelno >= logging.CRITICAL:
+            self.flush()
+
+    def write_lines(self, level, name, lines):
+        # Fast path for the raw output of a subprocess: the lines are formatted
+        # like records without paying for one LogRecord per line
+        prefix = "%s:%s:" % (logging.getLevelName(level), name)
+        self.buffer.extend(prefix + line for line in lines)
+        if len(self.buffer) >= self.capacity:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer and self.stream:
+                self.stream.write("\n".join(self.buffer) + "\n")
+                self.buffer = list()
+            logging.FileHandler.flush(self)
+        finally:
+            self.release()
+
+
+def create_logger(name, filename, overwrite=True, buffered=False):
+    if overwrite:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
     # Initialize the logger
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
     # Create a file handler
-    handler = logging.FileHandler(filename, mode="a+")
+    if buffered:
+        handler = BatchedFileHandler(filename)
+    else:
+        handler = logging.FileHandler(filename, mode="a+")
     handler.setLevel(logging.DEBUG)
     # Create a logging format
     formatter = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
@@ -40,15 +102,23 @@ def create_logger(name, filename):
     return logger
 
 
-def create_command(args, curr_fa, curr_db):
-    cmd = 'python3.5 \"%s\" -query \"%s\" -db_fa \"%s\" '\
+def close_logger(logger):
+    while logger.handlers:
+        logger.handlers.pop().close()
+
+
+def create_command(args, curr_fa, curr_db, curr_outdir, nb_threads, prebuilt_db=False):
+    # When the target database was already formatted in the cache of the batch,
+    # ISF is handed a no-op in place of makeblastdb
+    mkdb = 'true' if prebuilt_db else args.mkdb_
+    cmd = '%s \"%s\" -query \"%s\" -db_fa \"%s\" '\
           '-th %s -run %s -pident_thr %s -cov_thr %s -eval_thr %s '\
           '-min_size %s -max_size %s -test_all_chain %s '\
           '-mkdb_ %s -faa_split %s -wd %s' % \
-          (args.isf_path, curr_fa, curr_db,
-           args.th, args.run, args.pident_thr, args.cov_thr, args.eval_thr,
+          (args.python, args.isf_path, curr_fa, curr_db,
+           nb_threads, args.run, args.pident_thr, args.cov_thr, args.eval_thr,
            args.min_size, args.max_size, args.test_all_chain,
-           args.mkdb_, args.faa_split, curr_outdir)
+           mkdb, args.faa_split, curr_outdir)
     if args.nr_db:
         cmd = "%s -nr_db %s" % (cmd, args.nr_db)
     if args.diamond:
@@ -58,6 +128,501 @@ def create_command(args, curr_fa, curr_db):
     return cmd
 
 
+def isf_arguments(args):
+    # Arguments that shape the gene family built by ISF; the number of
+    # threads and the paths to the executables are left out on purpose
+    return {'isf_path': args.isf_path, 'run': args.run, 'pident_thr': args.pident_thr,
+            'cov_thr': args.cov_thr, 'eval_thr': args.eval_thr, 'min_size': args.min_size,
+            'max_size': args.max_size, 'test_all_chain': args.test_all_chain,
+            'diamond': args.diamond, 'nr_db': args.nr_db}
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, mode='r') as f:
+            manifest = json.load(f)
+        f.close()
+    except (OSError, ValueError):
+        manifest = dict()
+    # replay the checkpoints written since the manifest was last compacted
+    try:
+        with open(manifest_path + '.journal', mode='r') as f:
+            for line in f:
+                try:
+                    manifest.update(json.loads(line))
+                except ValueError:
+                    # last line cut short by a killed batch
+                    pass
+        f.close()
+    except OSError:
+        pass
+    return manifest
+
+
+def write_manifest(manifest, manifest_path):
+    # Write to a temporary file first so that a batch killed while writing
+    # never leaves a truncated manifest behind
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, mode='w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    os.replace(tmp_path, manifest_path)
+    # the journal is now part of the manifest
+    try:
+        os.remove(manifest_path + '.journal')
+    except OSError:
+        pass
+
+
+def checkpoint_manifest(manifest, fa_names, manifest_path):
+    # Append the new state of the seeds to the journal of the manifest: rewriting
+    # the whole manifest after each job would cost O(n^2) on large batches
+    with open(manifest_path + '.journal', mode='a') as f:
+        for fa_name in fa_names:
+            f.write("%s\n" % json.dumps({fa_name: manifest[fa_name]}, sort_keys=True))
+    f.close()
+
+
+def list_family_outputs(curr_outdir):
+    outputs = dict()
+    for f in glob(os.path.join(curr_outdir, "sequence_found*.faa*")):
+        outputs[os.path.basename(f)] = os.path.getsize(f)
+    return outputs
+
+
+def is_job_complete(entry, fa_hash, curr_db, isf_args, curr_outdir):
+    # A seed is complete if its last run succeeded with the same input, target
+    # database and arguments, and if all of its outputs are still there, unchanged
+    if not entry or entry.get('exit_status') != 0 or entry.get('status') != 'done':
+        return False
+    if entry.get('fasta_sha256') != fa_hash or entry.get('db') != curr_db \
+            or entry.get('isf_args') != isf_args:
+        return False
+    if not entry.get('outputs'):
+        return False
+    for f, size in entry['outputs'].items():
+        path = os.path.join(curr_outdir, f)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+    return True
+
+
+def symlink_force(src, dst):
+    # Replace a link left by a previous run of the batch instead of
+    # failing with FileExistsError
+    if os.path.lexists(dst):
+        os.remove(dst)
+    os.symlink(os.path.abspath(src), dst)
+
+
+def link_family_outputs(curr_outdir, fa_name, all_dir, retrieve_dir):
+    # create a symbolic link of the comprehensive gene family into the summary directory
+    summary_all_files = glob(os.path.join(curr_outdir, "sequence_found_and_bases.faa*"))
+    for f in summary_all_files:
+        symlink_force(f, os.path.join(all_dir, fa_name + os.path.splitext(f)[1]))
+    # proceed likewise for retrieved sequences
+    summary_retrieved_files = glob(os.path.join(curr_outdir, "sequence_found.faa*"))
+    for f in summary_retrieved_files:
+        symlink_force(f, os.path.join(retrieve_dir, fa_name + os.path.splitext(f)[1]))
+
+
+def hash_target_db(db_path, cache_dir):
+    # Hashing an nr-sized fasta takes minutes: remember the hash of each
+    # database as long as its size and modification time are unchanged
+    index_path = os.path.join(cache_dir, "db_hashes.json")
+    index = load_manifest(index_path)
+    db_path = os.path.abspath(db_path)
+    stat = os.stat(db_path)
+    entry = index.get(db_path)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+    sha = pipeline_utils.hash_file(db_path)
+    # reload the index in case a concurrent batch updated it meanwhile
+    index = load_manifest(index_path)
+    index[db_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha}
+    write_manifest(index, index_path)
+    return sha
+
+
+def build_target_db(args, db_path, cache_dir, general_log):
+    # Format the target database once with makeblastdb into <cache_dir>/<sha256>_blast/
+    # and return the path to the fasta whose formatted database lies next to it
+    # (or None if it could not be formatted)
+    try:
+        db_sha = hash_target_db(db_path, cache_dir)
+    except OSError as e:
+        general_log.critical("The database of \"%s\" cannot be read: %s" % (db_path, e))
+        return None
+    db_dir = os.path.join(cache_dir, "%s_blast" % db_sha)
+    db_fa = os.path.join(db_dir, os.path.basename(db_path))
+    if os.path.isfile(os.path.join(db_dir, ".complete")):
+        general_log.info("Reusing the database of \"%s\" formatted in %s" % (db_path, db_dir))
+        return db_fa
+
+    # build into a private directory which is renamed once complete, so that
+    # concurrent batches never see a partially formatted database
+    tmp_dir = "%s.tmp.%d" % (db_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    tmp_fa = os.path.join(tmp_dir, os.path.basename(db_path))
+    os.symlink(os.path.abspath(db_path), tmp_fa)
+    cmd = [args.mkdb_, '-in', tmp_fa, '-dbtype', 'prot', '-out', tmp_fa]
+    general_log.info("Formatting the database of \"%s\" as: %s" % (db_path, " ".join(cmd)))
+    print("Formatting the database of \"%s\"" % db_path)
+
+    with instrumentation.stage('format_database') as timer:
+        build_result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if build_result.returncode != 0:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        general_log.critical("Formatting the database of \"%s\" failed:\n%s" %
+                             (db_path, build_result.stdout.decode('utf-8', errors='replace')))
+        return None
+    general_log.info("Database of \"%s\" formatted in %s" %
+                     (db_path, instrumentation.format_duration(timer.elapsed)))
+
+    with open(os.path.join(tmp_dir, ".complete"), mode='w') as f:
+        f.write("%s\n" % os.path.abspath(db_path))
+    f.close()
+    try:
+        os.rename(tmp_dir, db_dir)
+    except OSError:
+        # another batch completed the same database in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    # the symlink was created in tmp_dir and keeps pointing to the original fasta
+    return db_fa
+
+
+def read_fasta_size(fasta):
+    # (a missing or unreadable seed counts as empty: its own job reports it as failed)
+    nb_sequences = nb_residues = 0
+    try:
+        with open(fasta, mode='r') as f:
+            for line in f:
+                if line.startswith('>'):
+                    nb_sequences += 1
+                else:
+                    nb_residues += len(line.strip())
+        f.close()
+    except OSError:
+        return [0, 0]
+    return [nb_sequences, nb_residues]
+
+
+def load_timing_history(tsv_paths, manifest):
+    # Wall time of the seeds completed by earlier batches, keyed by (family, db)
+    history = dict()
+    for tsv_path in tsv_paths:
+        with open(tsv_path, mode='r') as f:
+            columns = next(f).lstrip('#').rstrip('\n').split('\t')
+            for row in f:
+                metrics = dict(zip(columns, row.rstrip('\n').split('\t')))
+                if metrics.get('status') == 'done' and metrics.get('wall_time_s'):
+                    history[(metrics['family'], metrics['db'])] = float(metrics['wall_time_s'])
+        f.close()
+    # the manifest of the output directory holds the most recent timings
+    for fa_name, entry in manifest.items():
+        metrics = entry.get('metrics')
+        if metrics and metrics['status'] == 'done':
+            history[(fa_name, entry['db'])] = metrics['wall_time_s']
+    return history
+
+
+def estimate_job_costs(fa_paths, seed_dbs, history):
+    # A search costs roughly the length of the queries times the size of the
+    # target database; the estimates are turned into seconds with the median
+    # ratio between past wall times and estimates, and replaced by the past
+    # wall time itself for the seeds that already ran
+    estimates = list()
+    ratios = list()
+    for i in range(0, len(fa_paths)):
+        fa_name = os.path.splitext(os.path.basename(fa_paths[i]))[0]
+        nb_sequences, nb_residues = read_fasta_size(fa_paths[i])
+        try:
+            db_size = os.path.getsize(seed_dbs[i])
+        except OSError:
+            db_size = 0
+        estimate = max(nb_residues, 1) * max(db_size, 1)
+        estimates.append(estimate)
+        past_time = history.get((fa_name, seed_dbs[i]))
+        if past_time:
+            ratios.append(past_time / float(estimate))
+    scale = sorted(ratios)[len(ratios) // 2] if ratios else 1.0
+    costs = list()
+    for i in range(0, len(fa_paths)):
+        fa_name = os.path.splitext(os.path.basename(fa_paths[i]))[0]
+        past_time = history.get((fa_name, seed_dbs[i]))
+        costs.append(past_time if past_time else estimates[i] * scale)
+    return costs
+
+
+def order_jobs(policy, costs):
+    # Dispatching the most expensive seeds first keeps the tail of a parallel
+    # batch short: the small seeds fill the slots left by the large ones
+    order = list(range(0, len(costs)))
+    if policy == 'largest_first':
+        order.sort(key=lambda i: -costs[i])
+    elif policy == 'smallest_first':
+        order.sort(key=lambda i: costs[i])
+    return order
+
+
+async def read_stream(stream, fa_name, level, current_log, stderr_tail=None, progress=None):
+    # Read the output of ISF by chunks and hand over whole lines by batches
+    # to the log of the instance and to the console
+    handler = current_log.handlers[0]
+    nb_lines = 0
+    remainder = b''
+    while True:
+        chunk = await stream.read(2**16)
+        if not chunk:
+            lines = [remainder] if remainder else []
+        else:
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+        if lines:
+            lines = [line.decode('utf-8', errors='replace') for line in lines]
+            nb_lines += len(lines)
+            handler.write_lines(level, current_log.name, lines)
+            sys.stdout.write("".join("[%s] %s\n" % (fa_name, line) for line in lines))
+            if stderr_tail is not None:
+                stderr_tail.extend(lines)
+            if progress is not None:
+                for iteration in ITERATION_PATTERN.findall("\n".join(lines)):
+                    progress['nb_iterations'] = max(progress['nb_iterations'], int(iteration))
+        if not chunk:
+            break
+    return nb_lines
+
+
+async def open_pipe_reader(loop, pipe):
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader
+
+
+def exit_status(status):
+    # same convention as subprocess: -N when killed by signal N
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+async def kill_process_group(process, reaper, grace_period=10):
+    # ISF runs through a shell and spawns blast: signal the whole group
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        await asyncio.wait_for(asyncio.shield(reaper), grace_period)
+    except asyncio.TimeoutError:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def supervise_isf(cmd, fa_name, current_log, timeout):
+    # stdout and stderr are drained concurrently so that neither pipe can fill up
+    # and block ISF; both go to the (buffered) log of the instance
+    loop = asyncio.get_event_loop()
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               start_new_session=True)
+    # the instance is reaped with wait4 to get the resources used by its whole
+    # process tree (the shell, ISF and the searches it waited for)
+    reaper = loop.run_in_executor(None, os.wait4, process.pid, 0)
+    stdout = await open_pipe_reader(loop, process.stdout)
+    stderr = await open_pipe_reader(loop, process.stderr)
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_LENGTH)
+    progress = {'nb_iterations': 0}
+    readers = asyncio.gather(read_stream(stdout, fa_name, logging.INFO, current_log,
+                                         progress=progress),
+                             read_stream(stderr, fa_name, logging.WARNING, current_log,
+                                         stderr_tail))
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.shield(readers), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        current_log.critical("ISF exceeded the time limit of %s seconds and was killed" % timeout)
+        await kill_process_group(process, reaper)
+    nb_stdout_lines, nb_stderr_lines = await readers
+    pid, status, rusage = await reaper
+    # tell Popen that the child is already reaped
+    process.returncode = exit_status(status)
+    usage = {'user_cpu_s': round(rusage.ru_utime, 3), 'sys_cpu_s': round(rusage.ru_stime, 3),
+             'max_rss_kb': rusage.ru_maxrss,
+             # block I/O operations are counted in 512-byte units
+             'read_bytes': rusage.ru_inblock * 512, 'written_bytes': rusage.ru_oublock * 512,
+             'nb_iterations': progress['nb_iterations']}
+    return [process.returncode, timed_out, nb_stderr_lines, list(stderr_tail), usage]
+
+
+def count_fasta_sequences(fasta):
+    nb_sequences = 0
+    try:
+        with open(fasta, mode='r') as f:
+            for line in f:
+                if line.startswith('>'):
+                    nb_sequences += 1
+        f.close()
+    except OSError:
+        pass
+    return nb_sequences
+
+
+def write_job_metrics(jobs_metrics, tsv_path):
+    with open(tsv_path, mode='w') as f:
+        f.write('#%s\n' % '\t'.join(JOB_METRICS))
+        for metrics in jobs_metrics:
+            f.write('%s\n' % '\t'.join('' if metrics.get(c) is None else str(metrics.get(c))
+                                        for c in JOB_METRICS))
+    f.close()
+
+
+def write_batch_report(jobs_metrics, batch_wall_time, nb_slowest, report_path):
+    run_jobs = [m for m in jobs_metrics if m['status'] != 'skipped']
+    done_jobs = [m for m in run_jobs if m['status'] == 'done']
+    slowest = sorted(run_jobs, key=lambda m: m['wall_time_s'], reverse=True)[:nb_slowest]
+    report = {'nb_seeds': len(jobs_metrics),
+              'nb_run': len(run_jobs),
+              'nb_done': len(done_jobs),
+              'nb_failed': len(run_jobs) - len(done_jobs),
+              'nb_skipped': len(jobs_metrics) - len(run_jobs),
+              'batch_wall_time_s': round(batch_wall_time, 3),
+              'seeds_per_hour': round(len(done_jobs) / batch_wall_time * 3600, 2) if batch_wall_time else 0,
+              'cpu_time_s': round(sum(m['user_cpu_s'] + m['sys_cpu_s'] for m in run_jobs), 3),
+              'max_rss_kb': max([m['max_rss_kb'] for m in run_jobs] or [0]),
+              'read_bytes': sum(m['read_bytes'] for m in run_jobs),
+              'written_bytes': sum(m['written_bytes'] for m in run_jobs),
+              'slowest_seeds': [{'family': m['family'], 'wall_time_s': m['wall_time_s'],
+                                 'nb_iterations': m['nb_iterations'],
+                                 'nb_sequences_retrieved': m['nb_sequences_retrieved']}
+                                for m in slowest]}
+    with open(report_path, mode='w') as f:
+        json.dump(report, f, indent=1)
+    f.close()
+    return report
+
+
+async def run_isf_job(args, i, curr_fa, curr_db, nb_threads, all_dir, retrieve_dir, general_log,
+                      manifest, prebuilt_dbs):
+    fa_name = os.path.splitext(os.path.basename(curr_fa))[0]
+    curr_outdir = os.path.join(args.output_dir, fa_name)
+
+    # a seed that cannot be read is recorded as a failed job, the batch goes on
+    isf_args = isf_arguments(args)
+    try:
+        fa_hash = pipeline_utils.hash_file(curr_fa)
+    except OSError as e:
+        err = "* the seed cannot be read: %s" % e
+        print(err)
+        general_log.critical("The following error has been produced for \"%s\":\n%s" % (fa_name, err))
+        metrics = {'family': fa_name, 'fasta': curr_fa, 'db': curr_db, 'status': 'failed',
+                   'exit_status': None, 'threads': nb_threads, 'wall_time_s': 0.0,
+                   'user_cpu_s': 0.0, 'sys_cpu_s': 0.0, 'max_rss_kb': 0, 'read_bytes': 0,
+                   'written_bytes': 0, 'nb_iterations': 0, 'nb_sequences_retrieved': 0}
+        manifest[fa_name] = {'fasta': curr_fa, 'fasta_sha256': None, 'db': curr_db,
+                             'isf_args': isf_args, 'exit_status': None, 'status': 'failed',
+                             'outputs': dict(), 'metrics': metrics}
+        checkpoint_manifest(manifest, [fa_name], args.manifest)
+        return metrics
+
+    # skip the seeds that a previous run of the batch already completed
+    if not args.rerun_all and \
+            is_job_complete(manifest.get(fa_name), fa_hash, curr_db, isf_args, curr_outdir):
+        record_msg = "Skipping \"%s\" (seq n°%s): already completed" % (fa_name, i+1)
+        general_log.info(record_msg)
+        print(record_msg)
+        link_family_outputs(curr_outdir, fa_name, all_dir, retrieve_dir)
+        return {'family': fa_name, 'fasta': curr_fa, 'db': curr_db, 'status': 'skipped'}
+
+    # log name of the current record
+    record_msg = "Executing ISF for \"%s\" (seq n°%s)" % (fa_name, i+1)
+    general_log.info(record_msg)
+    print(record_msg)
+
+    # Create an output subdirectory for the current instance of ISF
+    os.makedirs(curr_outdir, exist_ok=True)
+
+    # initialize logfile for the current instance of ISF
+    # (one logger per family since several instances may run concurrently)
+    current_log = create_logger('current_log.%s' % fa_name, os.path.join(curr_outdir, "ISF.log"),
+                                buffered=True)
+    current_log.propagate = False
+
+    # define ISF command line
+    prebuilt_db = prebuilt_dbs.get(curr_db)
+    if prebuilt_db:
+        cmd = create_command(args, curr_fa, prebuilt_db, curr_outdir, nb_threads, prebuilt_db=True)
+    else:
+        cmd = create_command(args, curr_fa, curr_db, curr_outdir, nb_threads)
+    current_log.info(cmd)
+
+    # run isf, compute time elapsed, and log everything !
+    start_time = time.time()
+    returncode, timed_out, nb_stderr_lines, stderr_tail, usage = \
+        await supervise_isf(cmd, fa_name, current_log, args.job_timeout)
+    elapsed_time = time.time() - start_time
+
+    # only the exit status tells whether ISF failed, stderr may just hold warnings
+    if timed_out or returncode != 0:
+        if timed_out:
+            err = "* ISF was killed after %s seconds" % args.job_timeout
+        else:
+            err = "* ISF exited with status %s" % returncode
+        if stderr_tail:
+            err = "%s, last lines of its stderr:\n%s" % (err, "\n".join(stderr_tail))
+        print(err)
+        current_log.critical(err)
+        general_log.critical("The following error has been produced for \"%s\":\n%s" % (fa_name, err))
+    else:
+        if nb_stderr_lines:
+            general_log.warning("ISF wrote %d line(s) on stderr for \"%s\" (see %s)" %
+                                (nb_stderr_lines, fa_name, os.path.join(curr_outdir, "ISF.log")))
+        general_log.info("Gene family \"%s\" successfully created in %s" %
+                         (fa_name, time.strftime("%H:%M:%S", time.gmtime(elapsed_time))))
+        link_family_outputs(curr_outdir, fa_name, all_dir, retrieve_dir)
+
+    # account for the resources used by the instance
+    metrics = {'family': fa_name, 'fasta': curr_fa, 'db': curr_db,
+               'status': 'done' if returncode == 0 and not timed_out else 'failed',
+               'exit_status': returncode, 'threads': nb_threads, 'wall_time_s': round(elapsed_time, 3),
+               'nb_sequences_retrieved':
+                   count_fasta_sequences(os.path.join(curr_outdir, "sequence_found.faa"))}
+    metrics.update(usage)
+
+    # checkpoint the state of the seed
+    manifest[fa_name] = {'fasta': curr_fa, 'fasta_sha256': fa_hash, 'db': curr_db,
+                         'isf_args': isf_args, 'exit_status': returncode,
+                         'status': metrics['status'],
+                         'outputs': list_family_outputs(curr_outdir),
+                         'metrics': metrics}
+    checkpoint_manifest(manifest, [fa_name], args.manifest)
+
+    sys.stdout.flush()
+    close_logger(current_log)
+    return metrics
+
+
+async def run_batch(args, fa_paths, seed_dbs, order, nb_jobs, nb_threads, all_dir, retrieve_dir,
+                    general_log, manifest, prebuilt_dbs):
+    # at most nb_jobs instances of ISF hold a slot of the thread budget at a time
+    slots = asyncio.Semaphore(nb_jobs)
+
+    async def run_in_slot(i, curr_db):
+        async with slots:
+            return await run_isf_job(args, i, fa_paths[i], curr_db, nb_threads, all_dir, retrieve_dir,
+                              general_log, manifest, prebuilt_dbs)
+
+    # the slots are handed over to the waiting jobs in the order of submission
+    jobs = list()
+    for i in order:
+        jobs.append(run_in_slot(i, seed_dbs[i]))
+    jobs_metrics = await asyncio.gather(*jobs)
+    # report the jobs in the order of the list of seeds
+    ordered_metrics = [None] * len(order)
+    for k in range(0, len(order)):
+        ordered_metrics[order[k]] = jobs_metrics[k]
+    return ordered_metrics
+
+
 parser = argparse.ArgumentParser(description='This script runs several instances of ISF')
 # ISF_batch_run_args
 parser.add_argument('--list_of_fasta_paths', dest='list_fa', type=str,
@@ -69,8 +634,38 @@ parser.add_argument('--output_dir', dest='output_dir', type=str,
                     help='specify the path to directory that will store all the ISF outputs')
 parser.add_argument('--ISF_path', dest='isf_path', type=str,
                     help='specify the path to isf_main.py')
+parser.add_argument('--python', dest='python', type=str, default='python3.5',
+                    help='specify the python interpreter that runs isf_main.py ("python3.5" by default)')
+parser.add_argument('--parallel_jobs', dest='jobs', type=int, default=1,
+                    help='specify the number of instances of ISF to run concurrently; '
+                         'the threads given by -th are split between them (1 by default)')
+parser.add_argument('--job_timeout', dest='job_timeout', type=float,
+                    help='specify a wall-clock limit (in seconds) after which an instance '
+                         'of ISF is killed and its seed reported as failed (optional)')
+parser.add_argument('--db_cache_dir', dest='db_cache_dir', type=str,
+                    help='specify the directory where each target database is formatted once '
+                         'and reused by all the jobs of the batch and by later batches '
+                         '(<output_dir>/00_db_cache by default)')
+parser.add_argument('--no_db_cache', dest='no_db_cache', action='store_true', default=False,
+                    help='let each instance of ISF format its target database itself; the instances '
+                         'then run one at a time (optional)')
+parser.add_argument('--job_order', dest='job_order', type=str, default='largest_first',
+                    choices=['largest_first', 'smallest_first', 'file'],
+                    help='specify the order in which seeds are dispatched: by decreasing or '
+                         'increasing expected cost, or in the order of --list_of_fasta_paths '
+                         '("largest_first" by default)')
+parser.add_argument('--timing_history', dest='timing_history', type=str, nargs='*', default=[],
+                    help='specify the paths to ISF_batch_jobs.tsv files of earlier batches whose '
+                         'timings refine the expected cost of the seeds (optional)')
+parser.add_argument('--report_slowest', dest='nb_slowest', type=int, default=10,
+                    help='specify the number of slowest seeds listed in the performance report '
+                         'of the batch (10 by default)')
+parser.add_argument('--rerun_all', dest='rerun_all', action='store_true', default=False,
+                    help='rerun every seed instead of skipping those that a previous run '
+                         'of the batch already completed (optional)')
 # ISF_args
-parser.add_argument('-th', help='number of thread to use', type=int, required=True)
+parser.add_argument('-th', help='number of thread to use (global budget shared by the batch)',
+                    type=int, required=True)
 parser.add_argument('-run', help='number of run to do', type=int, default=10**6)
 parser.add_argument('-pident_thr', help='threshold limit for identity default = 30.0, value > 0.0',
                     type=float, default=30.0)
@@ -94,16 +689,37 @@ parser.add_argument('-faa_split', help='where is exonerate fastasplit, default u
                     default='fastasplit')
 parser.add_argument('-nr_db', help='path to nr database, if set when the iteration finish \
 results are blast against nr', type=str)
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.start(args)
 
 #####################################################
 # SETUP #############################################
 #####################################################
+# Concurrent instances of ISF may only share a target database formatted
+# beforehand in the cache: otherwise each of them formats it again next to
+# the fasta while the others read it. ISF formats the database of diamond
+# itself, so diamond databases are never taken from the cache
+if args.jobs > 1 and (args.diamond or args.no_db_cache):
+    sys.exit("--parallel_jobs > 1 requires the cache of formatted target databases, "
+             "which is not used with -diamond or --no_db_cache")
 # Read list of paths to input fasta and db
 fa_paths = read_list_of_paths(args.list_fa)
 db_paths = read_list_of_paths(args.list_db)
-# Initialize logfile
-general_log = create_logger('general_log', os.path.join(args.output_dir, "ISF_batch.log"))
+# define the target database of each seed
+if len(db_paths) == 1:
+    seed_dbs = db_paths * len(fa_paths)
+else:
+    seed_dbs = db_paths
+# Load the manifest that checkpoints the state of each seed of the batch
+args.manifest = os.path.join(args.output_dir, "ISF_batch_manifest.json")
+manifest = load_manifest(args.manifest)
+write_manifest(manifest, args.manifest)
+if args.rerun_all:
+    manifest = dict()
+# Initialize logfile (a resumed batch appends to the log of the previous run)
+general_log = create_logger('general_log', os.path.join(args.output_dir, "ISF_batch.log"),
+                            overwrite=args.rerun_all or not manifest)
 # Create a summary directory that will eventually store all the gene families
 all_dir = os.path.join(args.output_dir, "00_summary_all_sequences")
 os.makedirs(all_dir, exist_ok=True)
@@ -113,65 +729,65 @@ os.makedirs(retrieve_dir, exist_ok=True)
 #####################################################
 # BATCH RUN #########################################
 #####################################################
-for i in range(0, len(fa_paths)):
-    # define target database
-    if len(db_paths) == 1:
-        curr_db = db_paths[0]
-    else:
-        curr_db = db_paths[i]
-
-    # retrieve the fasta file to be processed
-    curr_fa = fa_paths[i]
-    fa_name = os.path.splitext(os.path.basename(curr_fa))[0]
-
-    # log name of the current record
-    record_msg = "Executing ISF for \"%s\" (seq n°%s)" % (fa_name, i+1)
-    general_log.info(record_msg)
-    print(record_msg)
+# Format each unique target database once for the whole batch
+prebuilt_dbs = dict()
+if not args.no_db_cache and not args.diamond:
+    if not args.db_cache_dir:
+        args.db_cache_dir = os.path.join(args.output_dir, "00_db_cache")
+    os.makedirs(args.db_cache_dir, exist_ok=True)
+    for curr_db in sorted(set(seed_dbs)):
+        prebuilt_db = build_target_db(args, curr_db, args.db_cache_dir, general_log)
+        if prebuilt_db:
+            prebuilt_dbs[curr_db] = prebuilt_db
+    # (the instances of ISF would format a database that failed to build concurrently)
+    if args.jobs > 1 and any(curr_db not in prebuilt_dbs for curr_db in seed_dbs):
+        general_log.warning("Some target databases could not be formatted in the cache: "
+                            "the instances of ISF run one at a time")
+        args.jobs = 1
 
-    # Create an output subdirectory for the current instance of ISF
-    curr_outdir = os.path.join(args.output_dir, fa_name)
-    os.makedirs(curr_outdir, exist_ok=True)
-
-    # initialize logfile for the current instance of ISF
-    current_log = create_logger('current_log', os.path.join(curr_outdir, "ISF.log"))
-
-    # define ISF command line
-    cmd = create_command(args, curr_fa, curr_db)
-    current_log.info(cmd)
-
-    # run isf, compute time elapsed, and log everything !
-    start_time = time.time()
+# Order the seeds according to their expected cost
+if args.job_order == 'file':
+    order = list(range(0, len(fa_paths)))
+else:
+    with instrumentation.stage('estimate_job_costs'):
+        costs = estimate_job_costs(fa_paths, seed_dbs,
+                                   load_timing_history(args.timing_history, manifest))
+    order = order_jobs(args.job_order, costs)
+general_log.info("Dispatching seeds by %s order" % args.job_order.replace('_', ' '))
 
-    ISF_result = subprocess.Popen(args=cmd, shell=True,
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    for line in ISF_result.stdout:
-        print(line)
-        current_log.info(line)
+# Split the global thread budget (-th) between the instances of ISF
+# that run concurrently (never more instances than seeds or threads)
+nb_jobs, threads_per_job = pipeline_utils.split_thread_budget(args.th, args.jobs, len(fa_paths))
+general_log.info("Running %d instance(s) of ISF concurrently with %d thread(s) each" %
+                 (nb_jobs, threads_per_job))
 
-    elapsed_time = time.time() - start_time
-
-    ISF_out, ISF_err = ISF_result.communicate()
-    if ISF_err:
-        err = "* ISF generated the following error:\n%s\n" % ISF_err
-        print(err)
-        current_log.critical("The following error has been produced:\n%s" % ISF_err)
-        general_log.critical("The following error has been produced for this query:\n%s" % ISF_err)
-    else:
-        general_log.info("Gene family successfully created in %s" %
-                         time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
-        # create a symbolic link of the comprehensive gene family into the summary directory
-        summary_all_files = glob(os.path.join(curr_outdir, "sequence_found_and_bases.faa*"))
-        for f in summary_all_files:
-            os.symlink(f, os.path.join(all_dir, fa_name + os.path.splitext(f)[1]))
-        # proceed likewise for retrieved sequences
-        summary_retrieved_files = glob(os.path.join(curr_outdir, "sequence_found.faa*"))
-        for f in summary_retrieved_files:
-            os.symlink(f, os.path.join(retrieve_dir, fa_name + os.path.splitext(f)[1]))
+batch_timer = instrumentation.stage('run_batch').start()
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+# one reaper thread per running instance of ISF
+loop.set_default_executor(ThreadPoolExecutor(max_workers=nb_jobs))
+jobs_metrics = loop.run_until_complete(run_batch(args, fa_paths, seed_dbs, order, nb_jobs,
+                                                 threads_per_job, all_dir, retrieve_dir,
+                                                 general_log, manifest, prebuilt_dbs))
+loop.close()
+batch_wall_time = batch_timer.stop()
+# compact the checkpoints of the batch into the manifest
+write_manifest(manifest, args.manifest)
 
+#####################################################
+# PERFORMANCE REPORT ################################
+#####################################################
+write_job_metrics(jobs_metrics, os.path.join(args.output_dir, "ISF_batch_jobs.tsv"))
+report = write_batch_report(jobs_metrics, batch_wall_time, args.nb_slowest,
+                            os.path.join(args.output_dir, "ISF_batch_report.json"))
+general_log.info("Batch completed in %s: %d seed(s) done, %d failed, %d skipped (%.1f seeds/hour)" %
+                 (time.strftime("%H:%M:%S", time.gmtime(batch_wall_time)), report['nb_done'],
+                  report['nb_failed'], report['nb_skipped'], report['seeds_per_hour']))
 
-    sys.stdout.flush()
-    current_log.handlers[0].close()
-    current_log.handlers.pop()
+for status in ['done', 'failed', 'skipped']:
+    instrumentation.count('seeds_%s' % status, report['nb_%s' % status])
+instrumentation.count('sequences_retrieved', sum(metrics.get('nb_sequences_retrieved') or 0
+                                                 for metrics in jobs_metrics))
 
-general_log.handlers[0].close()
+close_logger(general_log)
+instrumentation.finish()
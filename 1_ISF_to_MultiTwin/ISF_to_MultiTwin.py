@@ -8,43 +8,194 @@
 # thankful if you could report the incident for further improvements.
 
 import argparse
+import json
 import os
 import logging
+import multiprocessing
 import re
 import sys
 import tempfile
 import subprocess
 from ete3 import *
+from accession_index import AccessionIndex
+import species_relationships
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import instrumentation
 ncbi = NCBITaxa()
 
+# Number of names or taxids per query to the local NCBI taxonomy
+TAXONOMY_BATCH_SIZE = 5000
+
+# Patterns of the header parser
+# (id is identified as the string that comes straight after the ">" char)
+ID_PATTERN = re.compile(r'^> *([a-zA-Z0-9._-]+)')
+SPECIES_PATTERN = re.compile(r'\[.+\]')
+GENERIC_SPECIES_PATTERN = re.compile(r'\[[A-Z][^A-Z0-9.-]*?\]')
+STRAIN_PATTERN = re.compile(r'^\[[A-Z][a-z]+( |_)?(sp\. ?[^\]]*)?([A-Z]?[a-z]+( |_)?)?')
+
 def redirect_msg(msg, level = "info"):
     print(msg)
     if level == "info":
         logging.info(msg)
 
 
-def retrieve_lineages(species):
-    phylum = lineage = ""
+def parse_id(header):
+    return ID_PATTERN.match(header).group(1)
+
+
+def normalize_species(tag, consider_strains):
+    # tag is the "[species]" string of a header
+    if not consider_strains:
+        # get rid of characters related to strains while adding exception for sp. cases
+        if not GENERIC_SPECIES_PATTERN.match(tag):
+            curr_string = STRAIN_PATTERN.match(tag)
+            if curr_string:
+                tag = curr_string.group(0)
+    # (species are interned since a few names are repeated across many headers)
+    return sys.intern(tag[1:-1].rstrip())
+
+
+def parse_family(fasta, consider_strains, progress_every=0):
+    # Streams the headers of a fasta and returns the list of its headers, each of
+    # them as a list [id, list of species]; the list of species is None when the
+    # header has no [species] tag (it is then retrieved from the id of the sequence)
+    headers = list()
+    with open(fasta, mode="r") as f:
+        for line in f:
+            if not line.startswith('>'):
+                continue
+            header = line.rstrip('\n')
+            curr_species = SPECIES_PATTERN.findall(header)
+            if curr_species:
+                curr_species = [normalize_species(tag, consider_strains) for tag in curr_species]
+            else:
+                curr_species = None
+            headers.append([parse_id(header), curr_species])
+            if progress_every and len(headers) % progress_every == 0:
+                redirect_msg("    * %d ids processed" % len(headers))
+    f.close()
+    return headers
+
+
+def fasta_signature(fasta):
+    # (a fasta is considered unchanged as long as its size and mtime are)
+    stat = os.stat(fasta)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_cache_manifest(manifest_path, options):
+    # Returns the signatures of the families cached by a previous incremental run,
+    # or nothing if there was none or if it was run with other options
     try:
-        taxid = list(ncbi.get_name_translator([species]).values())[0][0]
-    except:
-        return ["", ""]
-
-    lineage_list = ncbi.get_lineage(taxid)
-    lineage = list(ncbi.get_taxid_translator([lineage_list[0]]).values())[0]
-    lineage_ranks_dict = ncbi.get_rank(lineage_list)
-    for i in range(1, len(lineage_list)):
-        curr_taxid = lineage_list[i]
-        curr_name = list(ncbi.get_taxid_translator([curr_taxid]).values())[0]
-        curr_rank = lineage_ranks_dict[curr_taxid]
-        if curr_rank == "phylum":
-            phylum = curr_name
-        lineage = lineage + '; ' + curr_name
-    if lineage == "{}":
-        return["", ""]
-    else:
-        return [lineage, phylum]
+        with open(manifest_path, mode='r') as f:
+            manifest = json.load(f)
+        f.close()
+    except (OSError, ValueError):
+        return dict()
+    if manifest.get("options") != options:
+        return dict()
+    return manifest["families"]
+
+
+def write_json(obj, path):
+    # (written to a temporary file first so that an interrupted run never
+    # leaves a truncated cache file behind)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode='w') as f:
+        json.dump(obj, f)
+    f.close()
+    os.replace(tmp_path, path)
+
 
+def load_fragment(fragment_path):
+    with open(fragment_path, mode='r') as f:
+        fragment = json.load(f)
+    f.close()
+    for header in fragment["headers"]:
+        header[1] = [sys.intern(species) for species in header[1]]
+    return fragment
+
+
+def parse_family_worker(job):
+    # (entry point of the worker processes of --processes)
+    fasta, consider_strains = job
+    return parse_family(fasta, consider_strains)
+
+
+def fetch_species_name(curr_id):
+    # Retrieve the organism of a sequence from its id: from the offline index if one
+    # was given (resolved by batches beforehand), else from NCBI with efetch
+    if accession_index:
+        if curr_id not in offline_species:
+            offline_species.update(accession_index.lookup_species([curr_id]))
+        return offline_species.get(curr_id, "")
+    return subprocess.check_output(
+        "efetch -db protein -id %s -format gpc \
+         | egrep 'INSDSeq_organism' \
+         | awk -F \"</?INSDSeq_organism>\" '{ printf($2); }'" % curr_id,
+        shell=True).decode('utf-8')
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def translate_names(species_list):
+    # one query per chunk of names; a chunk that the taxonomy database
+    # rejects (e.g. a name with quotes) is translated name by name.
+    # Returns a dictionary lowercase name -> taxid, as names are matched
+    # regardless of their case by the taxonomy database
+    name2taxid = dict()
+    for chunk in chunks(species_list, TAXONOMY_BATCH_SIZE):
+        try:
+            translated = ncbi.get_name_translator(chunk)
+        except:
+            translated = dict()
+            for species in chunk:
+                try:
+                    translated.update(ncbi.get_name_translator([species]))
+                except:
+                    pass
+        for species, taxids in translated.items():
+            name2taxid[species.lower()] = taxids[0]
+    return name2taxid
+
+
+def retrieve_lineages(species_list):
+    # Bulk version of the lineage resolution: all the names are translated to taxids,
+    # all the lineages are fetched, and the union of the taxids of these lineages is
+    # translated to names and ranks, each step in a few batched queries.
+    # Returns a dictionary species -> [lineage, phylum] for the species found
+    # (the names that only differ by their case are queried once)
+    names = dict((species.lower(), species) for species in sorted(species_list))
+    name2taxid = translate_names(sorted(names.values()))
+    taxids = sorted(set(name2taxid.values()))
+    lineage_lists = dict()
+    for chunk in chunks(taxids, TAXONOMY_BATCH_SIZE):
+        lineage_lists.update(ncbi.get_lineage_translator(chunk))
+    lineage_taxids = sorted(set(t for lineage_list in lineage_lists.values() for t in lineage_list))
+    taxid2name = dict()
+    taxid2rank = dict()
+    for chunk in chunks(lineage_taxids, TAXONOMY_BATCH_SIZE):
+        taxid2name.update(ncbi.get_taxid_translator(chunk))
+        taxid2rank.update(ncbi.get_rank(chunk))
+
+    lineages = dict()
+    for species in species_list:
+        lineage_list = lineage_lists.get(name2taxid.get(species.lower()))
+        if not lineage_list:
+            continue
+        phylum = ""
+        lineage_names = list()
+        for i in range(0, len(lineage_list)):
+            curr_name = taxid2name.get(lineage_list[i], "")
+            if i > 0 and taxid2rank.get(lineage_list[i]) == "phylum":
+                phylum = curr_name
+            lineage_names.append(curr_name)
+        lineages[species] = ['; '.join(lineage_names), phylum]
+    return lineages
 
 parser = argparse.ArgumentParser(
     description='For an ensemble of families of genes, this script associates to each family name a list of'
@@ -72,7 +223,28 @@ parser.add_argument('--dictionary', dest='dictionary', type=str,
                          'description associated to each of these sequence ids, then you can specify its path '
                          'in order for the program to retrieve the corresponding sequence-species '
                          'relationship(s) (optional)')
+parser.add_argument('--accession_index', dest='accession_index', type=str,
+                    help='specify the path to an offline accession index built by accession_index.py '
+                         'in order to resolve the species of sequences whose header has no [species] '
+                         'tag without querying NCBI (optional)')
+parser.add_argument('--progress_every', dest='progress_every', type=int, default=100000,
+                    help='specify every how many ids the progress of the parsing of a family '
+                         'is reported, 0 to report only the families (100000 by default)')
+parser.add_argument('--processes', dest='processes', type=int, default=1,
+                    help='specify the number of processes parsing the families in parallel; '
+                         'the output is identical to the one of a serial run (1 by default)')
+parser.add_argument('--relationships_format', dest='relationships_format', type=str, default='tsv',
+                    choices=['tsv', 'npz', 'both'],
+                    help='specify the format of the species_sequences_relationships files: tabular, '
+                         'dictionary-encoded compressed npz (requires numpy, see species_relationships.py), '
+                         'or both (tsv by default)')
+parser.add_argument('--incremental', dest='incremental', action='store_true', default=False,
+                    help='whether to cache the parsed families in the output directory in order to '
+                         're-parse, at the next runs, only the families whose fasta was added or '
+                         'modified in the meantime (optional)')
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.start(args)
 
 ##########################################
 # SETUP ##################################
@@ -80,6 +252,9 @@ args = parser.parse_args()
 # get the directory of the executing script
 script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
 
+if args.relationships_format != 'tsv' and species_relationships.numpy is None:
+    sys.exit("numpy is required by --relationships_format %s" % args.relationships_format)
+
 # save the abspath of the output directory
 args.output_dir = os.path.abspath(args.output_dir)
 
@@ -105,98 +280,161 @@ comprehensive_output_dir = os.path.join(args.output_dir, "species_sequences_rela
 if not os.path.exists(comprehensive_output_dir):
     os.makedirs(comprehensive_output_dir)
 
-# define dictionary of families.
+# define dictionary of families (and of the parsed headers of each family,
+# a header being a list [id, list of species])
+family_headers = dict()
 multi_twin_dict = dict()
 multi_twin_dict["id"] = dict()
 multi_twin_dict["species"] = dict()
-if args.get_lineages:
-    multi_twin_dict["lineage"] = dict()
-    multi_twin_dict["phylum"] = dict()
+
+if args.accession_index:
+    accession_index = AccessionIndex(args.accession_index, ncbi)
+else:
+    accession_index = None
+
+# families to parse (in incremental mode, the families whose fasta is unchanged
+# since the previous run are loaded from the cache of their parsed headers
+# and lineages, and their species_sequences_relationships file is kept)
+parsed_families = list(family_names)
+cached_lineages = dict()
+if args.incremental:
+    cache_dir = os.path.join(args.output_dir, ".multitwin_cache")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    cache_manifest_path = os.path.join(cache_dir, "manifest.json")
+    cache_options = {"consider_strains": args.consider_strains, "get_lineages": args.get_lineages}
+    cached_families = load_cache_manifest(cache_manifest_path, cache_options)
+    family_signatures = dict()
+    parsed_families = list()
+    for i in range(0, len(fasta_files)):
+        curr_family = family_names[i]
+        family_signatures[curr_family] = fasta_signature(fasta_files[i])
+        fragment_path = os.path.join(cache_dir, curr_family + ".json")
+        if cached_families.get(curr_family) == family_signatures[curr_family] and os.path.isfile(fragment_path):
+            fragment = load_fragment(fragment_path)
+            family_headers[curr_family] = fragment["headers"]
+            cached_lineages.update(fragment.get("lineages", dict()))
+        else:
+            parsed_families.append(curr_family)
+    # forget the families whose fasta was removed
+    for curr_family in set(cached_families) - set(family_names):
+        for path in [os.path.join(cache_dir, curr_family + ".json"),
+                     os.path.join(comprehensive_output_dir, curr_family + species_relationships.TSV_SUFFIX),
+                     os.path.join(comprehensive_output_dir, curr_family + species_relationships.NPZ_SUFFIX)]:
+            if os.path.isfile(path):
+                os.remove(path)
+    redirect_msg("  * %d/%d families loaded from the cache, %d removed" %
+                 (len(family_names) - len(parsed_families), len(family_names),
+                  len(set(cached_families) - set(family_names))))
 
 ##########################################
 # JOB ####################################
 ##########################################
-for i in range(0, len(fasta_files)):
-    curr_fa = fasta_files[i]
-    curr_family = family_names[i]
-    multi_twin_dict["species"][curr_family] = list()
-    multi_twin_dict["id"][curr_family] = list()
-    redirect_msg("  * processing family %d/%d: %s" % (i+1, len(fasta_files), curr_family))
-
-    with open(fasta_files[i], mode="r") as f:
-
-        for line in f:
+family_fasta = dict(zip(family_names, fasta_files))
+parse_timer = instrumentation.stage('parse_families').start()
+if args.processes > 1 and len(parsed_families) > 1:
+    # the families are parsed by a pool of worker processes, and their headers
+    # collected in the order of the families (the lineages and the species of
+    # headers without [species] tag are resolved afterwards, once for all)
+    pool = multiprocessing.get_context('fork').Pool(min(args.processes, len(parsed_families)))
+    jobs = [(family_fasta[curr_family], args.consider_strains) for curr_family in parsed_families]
+    for i, headers in enumerate(pool.imap(parse_family_worker, jobs)):
+        curr_family = parsed_families[i]
+        family_headers[curr_family] = headers
+        redirect_msg("  * family %d/%d parsed: %s (%d ids)" % (i+1, len(parsed_families), curr_family, len(headers)))
+    pool.close()
+    pool.join()
+else:
+    for i in range(0, len(parsed_families)):
+        curr_family = parsed_families[i]
+        redirect_msg("  * processing family %d/%d: %s" % (i+1, len(parsed_families), curr_family))
+        family_headers[curr_family] = parse_family(family_fasta[curr_family], args.consider_strains,
+                                                   args.progress_every)
+        redirect_msg("    * %d ids processed" % len(family_headers[curr_family]))
+parse_timer.stop()
+instrumentation.count('families', len(family_names))
+instrumentation.count('families_parsed', len(parsed_families))
+instrumentation.count('sequences_parsed', sum(len(family_headers[curr_family]) for curr_family in parsed_families))
+
+# retrieve the species of the sequences whose header has no [species] tag
+# (by batches from the offline index if one was given)
+headers_without_species = [header for curr_family in parsed_families
+                           for header in family_headers[curr_family] if header[1] is None]
+instrumentation.count('sequences_without_species', len(headers_without_species))
+species_timer = instrumentation.stage('fetch_species').start()
+offline_species = dict()
+if accession_index and headers_without_species:
+    offline_species = accession_index.lookup_species([header[0] for header in headers_without_species])
+    redirect_msg("  * %d/%d sequence(s) without [species] tag resolved with the offline index" %
+                 (len(offline_species), len(headers_without_species)))
+for header in headers_without_species:
+    curr_species_name = fetch_species_name(header[0])
+    # (brackets added to be processed like the species of the header)
+    header[1] = [normalize_species('[%s]' % curr_species_name, args.consider_strains)] \
+        if curr_species_name else []
+species_timer.stop()
 
-            is_header = re.search(r'^>.*$', line)
-            if is_header:
-                header = is_header.group(0)
-
-                # (id is identified as the string that comes straight after the ">" char)
-                id = list()
-                tmp_id = re.search(r'^> *([a-zA-Z]|[0-9]|[-._])+', header)
-                tmp_id = re.split(r' *>', tmp_id.group(0))
-                curr_id = tmp_id[1]
-
-                redirect_msg("    * processing id %s" % (curr_id))
-
-                curr_species = re.findall(r'\[.+\]', header)
-                if args.get_lineages:
-                    curr_lineages = list()
-                    curr_phylum = list()
-
-                if not curr_species:
-                    curr_species_name = subprocess.check_output(
-                        "efetch -db protein -id %s -format gpc \
-                         | egrep 'INSDSeq_organism' \
-                         | awk -F \"</?INSDSeq_organism>\" '{ printf($2); }'" % curr_id,
-                        shell=True).decode('utf-8')
-                    curr_species = curr_species_name
-
-                j = 0
-                while j < len(curr_species):
-                    if not args.consider_strains:
-                        # get rid of characters related to strains while adding exception for sp. cases
-                        if not re.match(r'\[[A-Z][^A-Z0-9.-]*?\]', curr_species[j]):
-                            curr_string = re.match(r'^\[[A-Z][a-z]+( |_)?(sp\. ?[^\]]*)?([A-Z]?[a-z]+( |_)?)?',
-                                                   curr_species[j])
-                            try:
-                                curr_species[j] = curr_string.group(0)
-                            except:
-                                curr_species[j] = curr_species[j]
-                    curr_species[j] = curr_species[j][1:-1].rstrip()
-                    id.append(curr_id)
-                    if args.get_lineages:
-                        try:
-                            tmp = multi_twin_dict["lineage"][curr_species[j]]
-                        except:
-                            lineage_out = retrieve_lineages(curr_species[j])
-
-                            if not lineage_out[0]:
-                                curr_species_name = subprocess.check_output(
-                                    "efetch -db protein -id %s -format gpc \
-                                     | egrep 'INSDSeq_organism' \
-                                     | awk -F \"</?INSDSeq_organism>\" '{ printf($2); }'" % curr_id,
-                                    shell=True).decode('utf-8')
-                                curr_species = [curr_species_name]
-                                j = 0
-                                lineage_out = retrieve_lineages(curr_species[0])
-                            multi_twin_dict["lineage"][curr_species[j]] = dict()
-                            multi_twin_dict["phylum"][curr_species[j]] = dict()
-                            multi_twin_dict["lineage"][curr_species[j]] = lineage_out[0]
-                            multi_twin_dict["phylum"][curr_species[j]] = lineage_out[1]
-                    j = j+1
-
-                redirect_msg("      found [%s]" % curr_species[0])
-
-                multi_twin_dict["species"][curr_family] = multi_twin_dict["species"][curr_family] + curr_species
-                multi_twin_dict["id"][curr_family] = multi_twin_dict["id"][curr_family] + id
 
-    f.close()
+##########################################
+# LINEAGES ###############################
+##########################################
+if args.get_lineages:
+    # resolve at once the lineages of all the species of the parsed families
+    parsed_headers = [header for curr_family in parsed_families for header in family_headers[curr_family]]
+    all_species = set(species for header in parsed_headers for species in header[1])
+    redirect_msg("  * retrieving the lineages of %d species" % len(all_species))
+    lineages_timer = instrumentation.stage('retrieve_lineages').start()
+    lineages = retrieve_lineages(all_species)
+
+    # a species unknown to the NCBI taxonomy is replaced by the organism
+    # of the sequence, which is retrieved from the id of the sequence
+    unresolved_headers = [header for header in parsed_headers
+                          if any(species not in lineages for species in header[1])]
+    if accession_index and unresolved_headers:
+        offline_species.update(accession_index.lookup_species(
+            [header[0] for header in unresolved_headers if header[0] not in offline_species]))
+    for header in unresolved_headers:
+        header[1] = [fetch_species_name(header[0])]
+    fetched_species = set(header[1][0] for header in unresolved_headers) - set(lineages)
+    lineages.update(retrieve_lineages(fetched_species))
+    lineages_timer.stop()
+    instrumentation.count('species', len(all_species | fetched_species))
+    instrumentation.count('species_resolved', len((all_species | fetched_species) & set(lineages)))
+
+    for species in all_species | fetched_species:
+        cached_lineages[species] = lineages.get(species, ["", ""])
+    multi_twin_dict["lineage"] = dict((species, cached_lineages[species][0]) for species in cached_lineages)
+    multi_twin_dict["phylum"] = dict((species, cached_lineages[species][1]) for species in cached_lineages)
+
+# cache the parsed families for the next incremental runs
+if args.incremental:
+    cache_timer = instrumentation.stage('write_cache').start()
+    for curr_family in parsed_families:
+        fragment = {"headers": family_headers[curr_family]}
+        if args.get_lineages:
+            fragment["lineages"] = dict((species, cached_lineages[species]) for header in family_headers[curr_family]
+                                        for species in header[1])
+        write_json(fragment, os.path.join(cache_dir, curr_family + ".json"))
+    write_json({"options": cache_options, "families": family_signatures}, cache_manifest_path)
+    cache_timer.stop()
+
+# flatten the headers into the lists of species and ids of each family
+for curr_family in family_names:
+    multi_twin_dict["species"][curr_family] = list()
+    multi_twin_dict["id"][curr_family] = list()
+    for curr_id, curr_species in family_headers[curr_family]:
+        multi_twin_dict["species"][curr_family].extend(curr_species)
+        multi_twin_dict["id"][curr_family].extend([curr_id] * len(curr_species))
 
 
 #############################################
 # OUTPUT ####################################
 #############################################
+output_timer = instrumentation.stage('write_outputs').start()
+parsed_set = set(parsed_families)
+relationships_formats = ['tsv', 'npz'] if args.relationships_format == 'both' else [args.relationships_format]
+relationships_suffixes = {'tsv': species_relationships.TSV_SUFFIX, 'npz': species_relationships.NPZ_SUFFIX}
+relationships_writers = {'tsv': species_relationships.write_tsv, 'npz': species_relationships.write_npz}
 with open(multi_twin_in, mode='w') as f1:
     if not args.get_lineages:
         f1.write('#family_name\tspecies\n')
@@ -219,20 +457,15 @@ with open(multi_twin_in, mode='w') as f1:
                              multi_twin_dict["phylum"][unique_species[j]],
                              multi_twin_dict["lineage"][unique_species[j]]))
 
-        curr_file = os.path.join(comprehensive_output_dir, curr_family + 'species_sequences_relationships.tsv')
-        with open(curr_file, mode='w') as f2:
-            if not args.get_lineages:
-                f2.write('#id\tspecies\n')
-            else:
-                f2.write('#family_name\tspecies\tphylum\tlineage\n')
-            for j in range(0, len(list_ids)):
-                if not args.get_lineages:
-                    f2.write('%s\t%s\n' % (list_ids[j], list_species[j]))
-                else:
-                    f2.write('%s\t%s\t%s\t%s\n' % (list_ids[j], list_species[j],
-                                                   multi_twin_dict["phylum"][list_species[j]],
-                                                   multi_twin_dict["lineage"][list_species[j]]))
-        f2.close()
+        for relationships_format in relationships_formats:
+            curr_file = os.path.join(comprehensive_output_dir, curr_family + relationships_suffixes[relationships_format])
+            # (the file of a family loaded from the cache is up to date)
+            if curr_family in parsed_set or not os.path.isfile(curr_file):
+                relationships_writers[relationships_format](
+                    curr_file, list_ids, list_species,
+                    multi_twin_dict.get("phylum"), multi_twin_dict.get("lineage"))
 
 f1.close()
+output_timer.stop()
 
+instrumentation.finish()
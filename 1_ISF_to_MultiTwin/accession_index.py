@@ -0,0 +1,165 @@
+#!/usr/local/bin/python3.5
+
+# Note: this script builds an offline index that resolves protein accessions
+# to species without querying NCBI. It is built once from local dumps of
+# NCBI's taxonomy (prot.accession2taxid[.gz], and optionally names.dmp) into
+# a sqlite database, that ISF_to_MultiTwin.py can then query by batches
+# (see its --accession_index option).
+
+import argparse
+import gzip
+import os
+import re
+import sqlite3
+import sys
+import time
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import pipeline_utils
+
+# Number of rows inserted at once while building the index
+INSERT_BATCH_SIZE = 100000
+
+
+def open_dump(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode='rt')
+    return open(path, mode='r')
+
+
+def strip_version(accession):
+    # taxid does not depend on the version of an accession (WP_000001.1 -> WP_000001)
+    return re.sub(r'\.[0-9]+$', '', accession)
+
+
+def read_accession2taxid(dump_path):
+    # columns: accession, accession.version, taxid, gi
+    with open_dump(dump_path) as f:
+        for row in f:
+            fields = row.split('\t')
+            if len(fields) < 3 or fields[0] == 'accession':
+                continue
+            yield (fields[0], int(fields[2]))
+    f.close()
+
+
+def read_scientific_names(names_dmp):
+    # columns: taxid | name | unique name | name class |
+    with open_dump(names_dmp) as f:
+        for row in f:
+            fields = row.split('\t|\t')
+            if len(fields) >= 4 and fields[3].startswith('scientific name'):
+                yield (int(fields[0]), fields[1])
+    f.close()
+
+
+def insert_by_batches(conn, query, rows):
+    batch = list()
+    nb_rows = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == INSERT_BATCH_SIZE:
+            conn.executemany(query, batch)
+            nb_rows += len(batch)
+            batch = list()
+    conn.executemany(query, batch)
+    return nb_rows + len(batch)
+
+
+def build_accession_index(dump_paths, index_path, names_dmp=None):
+    # The tables are filled first and indexed afterwards, which lets sqlite
+    # sort the keys once instead of maintaining a b-tree row after row
+    tmp_path = index_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('CREATE TABLE accession2taxid (accession TEXT, taxid INTEGER)')
+    for dump_path in dump_paths:
+        start_time = time.time()
+        nb_rows = insert_by_batches(conn, 'INSERT INTO accession2taxid VALUES (?, ?)',
+                                    read_accession2taxid(dump_path))
+        print('  * %d accessions read from %s in %s' %
+              (nb_rows, dump_path, time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))))
+    conn.execute('CREATE INDEX accession_idx ON accession2taxid (accession)')
+    if names_dmp:
+        conn.execute('CREATE TABLE taxid2name (taxid INTEGER PRIMARY KEY, name TEXT)')
+        nb_rows = insert_by_batches(conn, 'INSERT OR REPLACE INTO taxid2name VALUES (?, ?)',
+                                    read_scientific_names(names_dmp))
+        print('  * %d scientific names read from %s' % (nb_rows, names_dmp))
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, index_path)
+
+
+class AccessionIndex:
+    # Read-only access to an index built by build_accession_index
+
+    def __init__(self, index_path, ncbi=None):
+        self.conn = sqlite3.connect('file:%s?mode=ro' % os.path.abspath(index_path), uri=True)
+        self.ncbi = ncbi
+        self.has_names = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'taxid2name'").fetchone()
+
+    def lookup_taxids(self, accessions):
+        # Returns a dictionary accession -> taxid for the accessions found in the index
+        keys = dict()
+        for accession in accessions:
+            keys.setdefault(strip_version(accession), list()).append(accession)
+        unique_keys = list(keys)
+        taxids = dict()
+        for batch, placeholders in pipeline_utils.sqlite_batches(unique_keys):
+            rows = self.conn.execute('SELECT accession, taxid FROM accession2taxid '
+                                     'WHERE accession IN (%s)' % placeholders, batch)
+            for key, taxid in rows:
+                for accession in keys[key]:
+                    taxids[accession] = taxid
+        return taxids
+
+    def lookup_names(self, taxids):
+        # Returns a dictionary taxid -> scientific name, from names.dmp if it was
+        # indexed, else from the local NCBI taxonomy of ete3
+        unique_taxids = list(set(taxids))
+        if not self.has_names:
+            return self.ncbi.get_taxid_translator(unique_taxids) if self.ncbi else dict()
+        names = dict()
+        for batch, placeholders in pipeline_utils.sqlite_batches(unique_taxids):
+            rows = self.conn.execute('SELECT taxid, name FROM taxid2name '
+                                     'WHERE taxid IN (%s)' % placeholders, batch)
+            names.update(rows)
+        return names
+
+    def lookup_species(self, accessions):
+        # Returns a dictionary accession -> species name
+        taxids = self.lookup_taxids(accessions)
+        names = self.lookup_names(taxids.values())
+        species = dict()
+        for accession, taxid in taxids.items():
+            if taxid in names:
+                species[accession] = names[taxid]
+        return species
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='This script builds an offline index that resolves protein accessions to '
+                    'species from local NCBI dumps, for ISF_to_MultiTwin.py --accession_index')
+    parser.add_argument('-a', '--accession2taxid', dest='dumps', type=str, nargs='+', required=True,
+                        help='specify the path(s) to prot.accession2taxid-like dumps '
+                             '(ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/accession2taxid/, may be gzipped)')
+    parser.add_argument('-n', '--names_dmp', dest='names_dmp', type=str,
+                        help='specify the path to names.dmp (from taxdump.tar.gz) to resolve taxids '
+                             'to species names without ete3 (optional)')
+    parser.add_argument('-o', '--output', dest='index_path', type=str, required=True,
+                        help='specify the path to the index to build (sqlite database)')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    build_accession_index(args.dumps, args.index_path, args.names_dmp)
+    print('  * index built in %s: %s' %
+          (time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time)), args.index_path))
+    sys.stdout.flush()
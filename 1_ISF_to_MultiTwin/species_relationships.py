@@ -0,0 +1,105 @@
+#!/usr/local/bin/python3.5
+
+# Note: this module writes and reads the species-sequence relationships
+# of a family (species_sequences_relationships files of ISF_to_MultiTwin.py).
+# Besides the tabular export, the relationships can be stored as a compressed
+# npz where every string is stored once in a table and each row only holds
+# integer codes into these tables:
+#   ids, species                   string tables
+#   id_codes, species_codes        one code per row (int32)
+#   phylums, lineages              string tables (only with lineages)
+#   species_phylum_codes,          one code per entry of the species table (int32)
+#   species_lineage_codes
+# numpy is only required for the npz format.
+
+import argparse
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TSV_SUFFIX = 'species_sequences_relationships.tsv'
+NPZ_SUFFIX = 'species_sequences_relationships.npz'
+
+
+def write_tsv(path, ids, species, phylum=None, lineage=None):
+    # ids and species are the columns of the rows; phylum and lineage,
+    # if given, are dictionaries species -> phylum and species -> lineage
+    with open(path, mode='w') as f:
+        if lineage is None:
+            f.write('#id\tspecies\n')
+            for j in range(0, len(ids)):
+                f.write('%s\t%s\n' % (ids[j], species[j]))
+        else:
+            f.write('#family_name\tspecies\tphylum\tlineage\n')
+            for j in range(0, len(ids)):
+                f.write('%s\t%s\t%s\t%s\n' % (ids[j], species[j], phylum[species[j]], lineage[species[j]]))
+    f.close()
+
+
+def encode(column):
+    # Dictionary encoding of a column of strings: returns the table of its
+    # distinct values (in order of first occurrence) and the code of each value
+    table = dict()
+    codes = numpy.empty(len(column), dtype=numpy.int32)
+    for j in range(0, len(column)):
+        codes[j] = table.setdefault(column[j], len(table))
+    # (table listed by code, as the dict itself keeps no order before python 3.7)
+    return numpy.array(sorted(table, key=table.get), dtype=str), codes
+
+
+def write_npz(path, ids, species, phylum=None, lineage=None):
+    id_table, id_codes = encode(ids)
+    species_table, species_codes = encode(species)
+    columns = {'ids': id_table, 'id_codes': id_codes, 'species': species_table, 'species_codes': species_codes}
+    if lineage is not None:
+        columns['phylums'], columns['species_phylum_codes'] = encode([phylum[s] for s in species_table])
+        columns['lineages'], columns['species_lineage_codes'] = encode([lineage[s] for s in species_table])
+    # (written to a temporary file first, as numpy appends .npz to names without it)
+    tmp_path = path + '.tmp.npz'
+    numpy.savez_compressed(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+
+def load_npz(path):
+    # Returns the columns of an npz written by write_npz as a dictionary of arrays
+    with numpy.load(path, allow_pickle=False) as npz:
+        return dict((name, npz[name]) for name in npz.files)
+
+
+def decode_rows(columns):
+    # Yields the rows (id, species[, phylum, lineage]) of the columns returned by load_npz
+    ids = columns['ids'][columns['id_codes']]
+    species_codes = columns['species_codes']
+    species = columns['species'][species_codes]
+    if 'lineages' not in columns:
+        for j in range(0, len(ids)):
+            yield (str(ids[j]), str(species[j]))
+    else:
+        phylums = columns['phylums'][columns['species_phylum_codes'][species_codes]]
+        lineages = columns['lineages'][columns['species_lineage_codes'][species_codes]]
+        for j in range(0, len(ids)):
+            yield (str(ids[j]), str(species[j]), str(phylums[j]), str(lineages[j]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='This script exports a species_sequences_relationships npz as a tabular file')
+    parser.add_argument('-i', '--input', dest='npz_path', type=str, required=True,
+                        help='specify the path to the npz written by ISF_to_MultiTwin.py')
+    parser.add_argument('-o', '--output', dest='tsv_path', type=str, required=True,
+                        help='specify the path to the tabular file to write')
+    args = parser.parse_args()
+
+    columns = load_npz(args.npz_path)
+    rows = list(decode_rows(columns))
+    ids = [row[0] for row in rows]
+    species = [row[1] for row in rows]
+    if 'lineages' in columns:
+        phylum = dict((row[1], row[2]) for row in rows)
+        lineage = dict((row[1], row[3]) for row in rows)
+        write_tsv(args.tsv_path, ids, species, phylum, lineage)
+    else:
+        write_tsv(args.tsv_path, ids, species)
@@ -1,95 +1,436 @@
 #!/usr/local/bin/python3.5
 
 import argparse
+import concurrent.futures
+import io
 import subprocess
 import logging
 import os
+import shutil
 import sys
-import time
+import tempfile
 import re
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import annotation_cache
+import cog_annotation
+import cog_index
+import enrichment_matrix
+import instrumentation
+import pipeline_utils
 
 
-def run_rpsblast(args, fa, fa_basename):
+def run_rpsblast(args, fa, fa_basename, nb_threads=1, out_path=None):
+    # Returns whether rpsblast+ succeeded, i.e. exited with status 0 and wrote its output
+    if not out_path:
+        out_path = os.path.join(args.outdir, fa_basename + '_rpsblast.out')
     cmd = 'rpsblast+ -query \"%s\" -db %s '\
-          '-out %s -evalue %f -outfmt 6' %\
+          '-out %s -evalue %f -outfmt 6 -num_threads %d' %\
           (fa, os.path.basename(os.path.normpath(args.db)).split("_")[0],
-           os.path.join(args.outdir, fa_basename + '_rpsblast.out'), args.e_value)
+           out_path, args.e_value, nb_threads)
 
     logging.info('Executing rpsblast+ as: %s' % cmd)
     print('Executing rpsblast+ as: %s' % cmd)
 
-    start_time = time.time()
-    rpsblast_result = subprocess.Popen(args=cmd, shell=True,
-                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    elapsed_time = time.time() - start_time
+    # (timed until rpsblast+ exits, not only until it is launched)
+    with instrumentation.stage('rpsblast') as timer:
+        rpsblast_result = subprocess.Popen(args=cmd, shell=True,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        rpsblast_out, rpsblast_err = rpsblast_result.communicate()
+    return check_rpsblast(rpsblast_result.returncode, rpsblast_err, timer, out_path)
 
-    rpsblast_out, rpsblast_err = rpsblast_result.communicate()
-    if rpsblast_err:
-        err = "* rpsblast+ generated the following error:\n%s" % rpsblast_err
+
+def check_rpsblast(returncode, rpsblast_err, timer, out_path=None):
+    # only the exit status (and a missing output) tells whether rpsblast+
+    # failed, its stderr may just hold warnings
+    rpsblast_err = rpsblast_err.decode(cog_annotation.ENCODING).strip()
+    if returncode != 0 or (out_path and not os.path.isfile(out_path)):
+        err = "* rpsblast+ exited with status %s%s" % \
+              (returncode, ", its stderr:\n%s" % rpsblast_err if rpsblast_err else "")
         logging.critical(err)
         print(err)
-    else:
-        msg = '* rpsblast+ successfully ran in %s' % \
-              time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
-        logging.info(msg)
-        print(msg)
+        return False
+    if rpsblast_err:
+        logging.warning("* rpsblast+ wrote on stderr:\n%s" % rpsblast_err)
+    msg = '* rpsblast+ successfully ran in %s' % instrumentation.format_duration(timer.elapsed)
+    logging.info(msg)
+    print(msg)
+    return True
 
 
-def concat_seq_with_no_matches_to_rspblast_out(args, fa, fa_basename, script_dir):
-    cmd = 'awk -f \"%s\" \"%s\" \"%s\" > \"%s\"' %\
-          (os.path.join(script_dir, 'Subscripts', 'left_join_fa_cdd.awk'),
-           fa, os.path.join(args.outdir, fa_basename + '_rpsblast.out'),
-           os.path.join(args.outdir, fa_basename + '_comprehensive_rpsblast.out'))
+def keep_intermediate(args):
+    # (the streaming mode only writes the intermediate outputs if asked to)
+    return not args.streaming or args.keep_intermediate
 
-    logging.info('Concatenate sequences that have no cdd matches with rpsblast output : %s' % cmd)
-    print('Concatenate sequences that have no cdd matches with rpsblast output : %s' % cmd)
 
-    start_time = time.time()
-    concat_result = subprocess.Popen(args=cmd, shell=True,
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    elapsed_time = time.time() - start_time
+def annotate_hits(args, fa, fa_basename, cog_reference, hit_lines=None):
+    # left join of the sequences of the family with their hits (read from
+    # <family>_rpsblast.out, or from hit_lines if given), and COG annotation
+    # of the joined hits (--cog_enrichment)
+    comprehensive_rpsblast_out = None
+    if keep_intermediate(args) or not cog_reference:
+        comprehensive_rpsblast_out = os.path.join(args.outdir, fa_basename + '_comprehensive_rpsblast.out')
+    msg = 'Annotating the hits of %s%s' % (fa_basename, ' with COG categories' if cog_reference else '')
+    logging.info(msg)
+    print(msg)
 
-    concat_out, concat_err = concat_result.communicate()
-    if concat_err:
-        err = "* concatenation generated the following error:\n%s" % concat_err
+    try:
+        with instrumentation.stage('annotate_hits') as timer:
+            cog_outputs = [os.path.join(args.outdir, fa_basename + 'COG_comprehensive_output.txt'),
+                           os.path.join(args.outdir, fa_basename + 'COG_enrichment.txt')]
+            if hit_lines is None:
+                annotator = cog_annotation.annotate_rpsblast_out(
+                    fa, os.path.join(args.outdir, fa_basename + '_rpsblast.out'),
+                    comprehensive_rpsblast_out, cog_reference, *cog_outputs)
+            else:
+                annotator = cog_annotation.annotate_hit_stream(fa, hit_lines, cog_reference,
+                                                               comprehensive_rpsblast_out, *cog_outputs)
+    except (OSError, IndexError) as e:
+        err = "* annotation of %s generated the following error:\n%s" % (fa_basename, e)
         logging.critical(err)
         print(err)
-    else:
-        msg = '* concatenation successfully ran in %s' % \
-              time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
-        logging.info(msg)
-        print(msg)
+        # (the outputs written before the error are incomplete)
+        remove_family_outputs(args, fa_basename)
+        failed_families.append(fa_basename)
+        return
+    instrumentation.count('families')
+    if annotator:
+        instrumentation.count('annotated_rows', annotator.nb_rows)
+        instrumentation.count('hits', annotator.nb_hits)
+    # (counts of the COG letters kept for the enrichment matrix)
+    if args.enrichment_matrix:
+        family_annotators[fa_basename] = annotator
+    msg = '* annotation successfully ran in %s' % instrumentation.format_duration(timer.elapsed)
+    logging.info(msg)
+    print(msg)
 
 
-def convert_cddid_to_cogid(args, fa_basename, script_dir):
-    cmd = 'awk -v comprehensive_out=\"%s\" -v summary_out=\"%s\" '\
-          '-f \"%s\" \"%s\" \"%s\" \"%s\" \"%s\"' %\
-          (os.path.join(args.outdir, fa_basename + 'COG_comprehensive_output.txt'),
-           os.path.join(args.outdir, fa_basename + 'COG_enrichment.txt'),
-           os.path.join(script_dir, 'Subscripts', 'cdd_2_cog.awk'),
-           os.path.join(script_dir, '../required_files', 'fun.txt'),
-           os.path.join(args.outdir, fa_basename + '_comprehensive_rpsblast.out'),
-           os.path.join(script_dir, '../required_files', 'cddid.tbl'),
-           os.path.join(script_dir, '../required_files', 'whog'))
-
-    logging.info('Executing cdd 2 cog as: %s' % cmd)
-    print('Executing cdd 2 cog as: %s' % cmd)
-
-    start_time = time.time()
-    cdd2cog_result = subprocess.Popen(args=cmd, shell=True,
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    elapsed_time = time.time() - start_time
-
-    cdd2cog_out, cdd2cog_err = cdd2cog_result.communicate()
-    if cdd2cog_err:
-        err = "* cdd2cog+ generated the following error:\n%s" % cdd2cog_err
-        logging.critical(err)
-        print(err)
+def remove_family_outputs(args, fa_basename):
+    for suffix in ['_comprehensive_rpsblast.out', 'COG_comprehensive_output.txt', 'COG_enrichment.txt']:
+        if os.path.isfile(os.path.join(args.outdir, fa_basename + suffix)):
+            os.remove(os.path.join(args.outdir, fa_basename + suffix))
+
+
+def tee_lines(stream, copy):
+    # (iterates over the lines of a stream while copying them to a file)
+    for line in stream:
+        copy.write(line)
+        yield line
+
+
+def stream_rpsblast(args, fa, fa_basename, cog_reference, nb_threads=1):
+    # Search of a family whose tabular output is annotated as it is read from
+    # the pipe of rpsblast+ (<family>_rpsblast.out is only written with --keep_intermediate);
+    # returns whether rpsblast+ succeeded (the annotation of a failed search is discarded)
+    cmd = 'rpsblast+ -query \"%s\" -db %s -evalue %f -outfmt 6 -num_threads %d' %\
+          (fa, os.path.basename(os.path.normpath(args.db)).split("_")[0], args.e_value, nb_threads)
+
+    logging.info('Executing rpsblast+ as: %s' % cmd)
+    print('Executing rpsblast+ as: %s' % cmd)
+
+    with instrumentation.stage('stream_rpsblast') as timer, tempfile.TemporaryFile() as err_file:
+        rpsblast_result = subprocess.Popen(args=cmd, shell=True, stdout=subprocess.PIPE, stderr=err_file)
+        hit_lines = io.TextIOWrapper(rpsblast_result.stdout, encoding=cog_annotation.ENCODING, newline='\n')
+        if args.keep_intermediate:
+            copy = open(os.path.join(args.outdir, fa_basename + '_rpsblast.out'),
+                        mode='w', encoding=cog_annotation.ENCODING, newline='\n')
+            annotate_hits(args, fa, fa_basename, cog_reference, tee_lines(hit_lines, copy))
+            copy.close()
+        else:
+            annotate_hits(args, fa, fa_basename, cog_reference, hit_lines)
+        # (drain the pipe in case the annotation stopped before its end)
+        for line in hit_lines:
+            pass
+        hit_lines.close()
+        rpsblast_result.wait()
+        err_file.seek(0)
+        rpsblast_err = err_file.read()
+    if not check_rpsblast(rpsblast_result.returncode, rpsblast_err, timer):
+        # (the annotation of the hits read before the failure is incomplete)
+        family_annotators.pop(fa_basename, None)
+        remove_family_outputs(args, fa_basename)
+        return False
+    return True
+
+
+def annotate_family(args, fa, cog_reference, nb_threads):
+    # search of a family followed straight away by the annotation of its hits
+    # (a family whose search failed is reported at the end of the run)
+    fa_basename = os.path.basename(fa).split(".")[0]
+    if args.streaming:
+        succeeded = stream_rpsblast(args, fa, fa_basename, cog_reference, nb_threads)
     else:
-        msg = '* cdd2cog successfully ran in %s' % \
-              time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
+        succeeded = run_rpsblast(args, fa, fa_basename, nb_threads)
+        if succeeded:
+            annotate_hits(args, fa, fa_basename, cog_reference)
+    if not succeeded and fa_basename not in failed_families:
+        failed_families.append(fa_basename)
+    return fa_basename
+
+
+def remove_intermediate(args, fa_basenames):
+    # (in streaming mode, the demultiplexed <family>_rpsblast.out are removed once annotated)
+    if not keep_intermediate(args):
+        for fa_basename in fa_basenames:
+            os.remove(os.path.join(args.outdir, fa_basename + '_rpsblast.out'))
+
+
+def write_pooled_queries(fasta_files, pool_dir, nb_shards):
+    # Concatenate the sequences of all the families into nb_shards query files of
+    # about the same number of sequences. Each sequence is renamed Q<n>, n being
+    # its index in the returned list of [family basename, original id]
+    nb_sequences = 0
+    for fa in fasta_files:
+        with open(fa, mode='r') as f:
+            nb_sequences += sum(1 for line in f if line.startswith('>'))
+        f.close()
+    shard_size = max(1, -(-nb_sequences // nb_shards))
+
+    query_ids = list()
+    shard_paths = list()
+    shard = None
+    for fa in fasta_files:
+        fa_basename = os.path.basename(fa).split(".")[0]
+        with open(fa, mode='r') as f:
+            for line in f:
+                if line.startswith('>'):
+                    if len(query_ids) % shard_size == 0:
+                        if shard:
+                            shard.close()
+                        shard_paths.append(os.path.join(pool_dir, 'shard_%d.faa' % len(shard_paths)))
+                        shard = open(shard_paths[-1], mode='w')
+                    # (the id is the first word of the header, as for left_join_fa_cdd.awk)
+                    query_ids.append([fa_basename, line[1:].split(None, 1)[0] if line[1:].strip() else ''])
+                    shard.write('>Q%d\n' % (len(query_ids) - 1))
+                elif shard:
+                    # (the last line of a fasta may lack its newline)
+                    shard.write(line.rstrip('\n') + '\n')
+        f.close()
+    if shard:
+        shard.close()
+    return [shard_paths, query_ids]
+
+
+def demultiplex_rpsblast_out(args, shard_out_paths, query_ids, fa_basenames):
+    # Split the hits of the pooled searches back into the <family>_rpsblast.out
+    # of each family, with the original ids. The hits of a family are contiguous
+    # since the shards hold the families one after the other and rpsblast+
+    # reports the hits query after query, so one output is open at a time.
+    # (the hits of the families that are not in fa_basenames are left out)
+    fa_basenames = set(fa_basenames)
+    for fa_basename in fa_basenames:
+        open(os.path.join(args.outdir, fa_basename + '_rpsblast.out'), mode='w').close()
+    curr_basename = None
+    out = None
+    for shard_out_path in shard_out_paths:
+        with open(shard_out_path, mode='r') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                query, hit = line.split('\t', 1)
+                fa_basename, seq_id = query_ids[int(query[1:])]
+                if fa_basename not in fa_basenames:
+                    continue
+                if fa_basename != curr_basename:
+                    if out:
+                        out.close()
+                    out = open(os.path.join(args.outdir, fa_basename + '_rpsblast.out'), mode='a')
+                    curr_basename = fa_basename
+                out.write('%s\t%s' % (seq_id, hit))
+        f.close()
+    if out:
+        out.close()
+
+
+def run_shards(args, shard_paths, nb_shards, nb_threads):
+    # run concurrently the rpsblast+ of the shards, and return the paths to their
+    # outputs and whether the rpsblast+ of each shard succeeded
+    shard_out_paths = [shard_path + '_rpsblast.out' for shard_path in shard_paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, nb_shards)) as executor:
+        futures = [executor.submit(run_rpsblast, args, shard_path, None, nb_threads, shard_out_path)
+                   for shard_path, shard_out_path in zip(shard_paths, shard_out_paths)]
+        succeeded = [future.result() for future in futures]
+    return [shard_out_paths, succeeded]
+
+
+def read_shard_queries(shard_path):
+    # (indexes n of the queries of a shard, named Q<n> or S<n>)
+    with open(shard_path, mode='r') as f:
+        queries = [int(line[2:]) for line in f if line.startswith('>')]
+    f.close()
+    return queries
+
+
+def annotate_pooled_families(args, fasta_files, cog_reference, nb_shards, nb_jobs):
+    # All the families are searched at once by a few rpsblast+ (one per shard),
+    # so that the database is loaded once per shard instead of once per family
+    pool_dir = os.path.join(args.outdir, '.rpsblast_pool')
+    if os.path.exists(pool_dir):
+        shutil.rmtree(pool_dir)
+    os.makedirs(pool_dir)
+    with instrumentation.stage('write_pooled_queries'):
+        shard_paths, query_ids = write_pooled_queries(fasta_files, pool_dir, nb_shards)
+    instrumentation.count('sequences_searched', len(query_ids))
+    nb_shards, nb_threads = pipeline_utils.split_thread_budget(args.threads, len(shard_paths), len(shard_paths))
+    msg = 'Searching %d sequences of %d families in %d pooled shard(s) with %d thread(s) each' % \
+          (len(query_ids), len(fasta_files), len(shard_paths), nb_threads)
+    logging.info(msg)
+    print(msg)
+
+    shard_out_paths, succeeded = run_shards(args, shard_paths, nb_shards, nb_threads)
+    # the families with sequences in a shard whose search failed are not annotated
+    failed = set()
+    for shard_path, shard_succeeded in zip(shard_paths, succeeded):
+        if not shard_succeeded:
+            failed.update(query_ids[n][0] for n in read_shard_queries(shard_path))
+    failed_families.extend(sorted(failed))
+    fasta_files = [fa for fa in fasta_files if os.path.basename(fa).split(".")[0] not in failed]
+    fa_basenames = [os.path.basename(fa).split(".")[0] for fa in fasta_files]
+    with instrumentation.stage('demultiplex_rpsblast_out'):
+        demultiplex_rpsblast_out(args, [shard_out_path for shard_out_path, shard_succeeded
+                                        in zip(shard_out_paths, succeeded) if shard_succeeded],
+                                 query_ids, fa_basenames)
+    shutil.rmtree(pool_dir)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+        futures = [executor.submit(annotate_hits, args, fa, fa_basename, cog_reference)
+                   for fa, fa_basename in zip(fasta_files, fa_basenames)]
+        for future in futures:
+            future.result()
+    remove_intermediate(args, fa_basenames)
+
+
+def read_fasta_records(fa):
+    # Returns the list of [id, sequence] of the sequences of a fasta
+    # (the id is the first word of the header, as in write_pooled_queries)
+    records = list()
+    with open(fa, mode='r') as f:
+        for line in f:
+            if line.startswith('>'):
+                records.append([line[1:].split(None, 1)[0] if line[1:].strip() else '', list()])
+            elif records:
+                records[-1][1].append(line.strip())
+    f.close()
+    for record in records:
+        record[1] = ''.join(record[1])
+    return records
+
+
+def search_unique_sequences(args, sequences, nb_shards):
+    # Search each of the sequences (dictionary seq_hash -> sequence) once, in a few
+    # pooled shards; returns the dictionary seq_hash -> hits (as the list of the
+    # fields of the hits that follow the query id), without the sequences of the
+    # shards whose search failed
+    pool_dir = os.path.join(args.outdir, '.rpsblast_pool')
+    if os.path.exists(pool_dir):
+        shutil.rmtree(pool_dir)
+    os.makedirs(pool_dir)
+    seq_hashes = list(sequences)
+    shard_size = max(1, -(-len(seq_hashes) // nb_shards))
+    shard_paths = list()
+    for i in range(0, len(seq_hashes), shard_size):
+        shard_paths.append(os.path.join(pool_dir, 'shard_%d.faa' % len(shard_paths)))
+        with open(shard_paths[-1], mode='w') as f:
+            for j in range(i, min(i + shard_size, len(seq_hashes))):
+                f.write('>S%d\n%s\n' % (j, sequences[seq_hashes[j]]))
+        f.close()
+    nb_shards, nb_threads = pipeline_utils.split_thread_budget(args.threads, len(shard_paths), len(shard_paths))
+    msg = 'Searching %d distinct sequences in %d pooled shard(s) with %d thread(s) each' % \
+          (len(seq_hashes), len(shard_paths), nb_threads)
+    logging.info(msg)
+    print(msg)
+
+    shard_out_paths, succeeded = run_shards(args, shard_paths, nb_shards, nb_threads)
+    hits = dict()
+    for shard_path, shard_out_path, shard_succeeded in zip(shard_paths, shard_out_paths, succeeded):
+        if not shard_succeeded:
+            continue
+        for j in read_shard_queries(shard_path):
+            hits[seq_hashes[j]] = list()
+        with open(shard_out_path, mode='r') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                query, hit = line.rstrip('\n').split('\t', 1)
+                hits[seq_hashes[int(query[1:])]].append(hit)
+        f.close()
+    shutil.rmtree(pool_dir)
+    return hits
+
+
+def cached_hit_lines(records, hits):
+    # Lines of the <family>_rpsblast.out of a family rebuilt from the cached hits
+    # of its sequences (records [id, seq_hash]), in the order of its fasta
+    for seq_id, seq_hash in records:
+        for hit in hits[seq_hash]:
+            yield '%s\t%s\n' % (seq_id, hit)
+
+
+def annotate_cached_families(args, fasta_files, cog_reference, nb_shards, nb_jobs):
+    # The sequences of all the families are deduplicated, and only the ones that are
+    # not in the annotation cache yet are searched; the <family>_rpsblast.out are
+    # then rebuilt from the hits of the cache
+    cache = annotation_cache.AnnotationCache(args.annotation_cache, annotation_cache.describe_db(args.db),
+                                             args.e_value, args.cache_max_size * 2**20)
+    family_records = list()
+    sequences = dict()
+    for fa in fasta_files:
+        records = read_fasta_records(fa)
+        for record in records:
+            seq_hash = annotation_cache.hash_sequence(record[1])
+            sequences.setdefault(seq_hash, record[1])
+            record[1] = seq_hash
+        family_records.append(records)
+    with instrumentation.stage('cache_lookup'):
+        hits = cache.lookup(sequences)
+    instrumentation.count('sequences', sum(len(records) for records in family_records))
+    instrumentation.count('distinct_sequences', len(sequences))
+    instrumentation.count('cached_sequences', len(hits))
+    unseen = dict((seq_hash, sequence) for seq_hash, sequence in sequences.items() if seq_hash not in hits)
+    msg = '%d sequences in %d families: %d distinct, %d found in the annotation cache' % \
+          (sum(len(records) for records in family_records), len(fasta_files), len(sequences), len(hits))
+    logging.info(msg)
+    print(msg)
+
+    if unseen:
+        # (only the hits of the shards whose search succeeded are cached)
+        new_hits = search_unique_sequences(args, unseen, nb_shards)
+        instrumentation.count('sequences_searched', len(unseen))
+        with instrumentation.stage('cache_store'):
+            cache.store(new_hits)
+        hits.update(new_hits)
+    nb_evicted = cache.evict()
+    if nb_evicted:
+        msg = '%d least recently used sequences evicted from the annotation cache' % nb_evicted
         logging.info(msg)
         print(msg)
+    cache.close()
+
+    # the families with sequences whose search failed are not annotated
+    fa_basenames = list()
+    for fa, records in zip(fasta_files, family_records):
+        fa_basenames.append(os.path.basename(fa).split(".")[0])
+        if not all(seq_hash in hits for seq_id, seq_hash in records):
+            failed_families.append(fa_basenames[-1])
+    failed = set(failed_families)
+    family_records = [records for fa_basename, records in zip(fa_basenames, family_records)
+                      if fa_basename not in failed]
+    fasta_files = [fa for fa, fa_basename in zip(fasta_files, fa_basenames) if fa_basename not in failed]
+    fa_basenames = [fa_basename for fa_basename in fa_basenames if fa_basename not in failed]
+    if keep_intermediate(args):
+        for fa_basename, records in zip(fa_basenames, family_records):
+            with open(os.path.join(args.outdir, fa_basename + '_rpsblast.out'), mode='w') as f:
+                for line in cached_hit_lines(records, hits):
+                    f.write(line)
+            f.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+        futures = [executor.submit(annotate_hits, args, fa, fa_basename, cog_reference,
+                                   None if keep_intermediate(args) else
+                                   cached_hit_lines(records, hits))
+                   for fa, fa_basename, records in zip(fasta_files, fa_basenames, family_records)]
+        for future in futures:
+            future.result()
 
 
 parser = argparse.ArgumentParser(
@@ -116,7 +457,40 @@ parser.add_argument('--evalue', dest='e_value', type=float,
 parser.add_argument('--cog_enrichment', dest='cog_enrich', action='store_true', default=False,
                     help='weither you want to compute the enrichment in each COG functional category '
                          'of the gene family (only relevant if --db was set to */COG_LE/)')
+parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                    help='specify the number of families annotated concurrently; the threads '
+                         'given by --threads are split between their rpsblast+ (1 by default)')
+parser.add_argument('--threads', dest='threads', type=int, default=1,
+                    help='specify the number of threads shared by the concurrent rpsblast+ '
+                         '(1 by default)')
+parser.add_argument('--pooled', dest='pooled', action='store_true', default=False,
+                    help='whether to search all the families at once by pooling their sequences '
+                         'into a few rpsblast+ queries (see --shards), which is faster for many small '
+                         'families; the outputs are split back by family (optional)')
+parser.add_argument('--shards', dest='shards', type=int, default=1,
+                    help='specify the number of rpsblast+ run concurrently on parts of the pooled '
+                         'sequences (only relevant with --pooled or --annotation_cache, 1 by default)')
+parser.add_argument('--streaming', dest='streaming', action='store_true', default=False,
+                    help='whether to annotate the hits of rpsblast+ as they are read from its output, '
+                         'without writing the intermediate _rpsblast.out and _comprehensive_rpsblast.out '
+                         '(unless --keep_intermediate) (optional)')
+parser.add_argument('--keep_intermediate', dest='keep_intermediate', action='store_true', default=False,
+                    help='whether to write the intermediate outputs in streaming mode as well (optional)')
+parser.add_argument('--enrichment_matrix', dest='enrichment_matrix', type=str,
+                    help='specify the path to a families x COG letters matrix (npz, requires numpy) of '
+                         'the occurrences and percentages of the letters in each family, to which the '
+                         'annotated families are added (requires --cog_enrichment, optional)')
+parser.add_argument('--annotation_cache', dest='annotation_cache', type=str,
+                    help='specify the path to a cache of the hits of the sequences (sqlite database, '
+                         'created if missing) shared between families and runs: the sequences of all the '
+                         'families are deduplicated and only the ones not cached yet are searched, '
+                         'pooled as with --pooled (optional)')
+parser.add_argument('--cache_max_size', dest='cache_max_size', type=int, default=1024,
+                    help='specify the size (in MB) beyond which the least recently used sequences '
+                         'are evicted from the annotation cache (1024 by default)')
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.start(args)
 
 
 ##########################################
@@ -125,11 +499,27 @@ args = parser.parse_args()
 # get the directory of the executing script
 script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
 
+if args.enrichment_matrix:
+    if not args.cog_enrich:
+        sys.exit("--enrichment_matrix requires --cog_enrichment")
+    if enrichment_matrix.numpy is None:
+        sys.exit("numpy is required by --enrichment_matrix")
+
 # get working directory
 working_directory = os.getcwd()
 
-# save the abspath of the output directory
+# save the abspath of the output directory (and of the inputs and the db, as
+# the script changes into the db directory)
 args.outdir = os.path.abspath(args.outdir)
+args.db = os.path.abspath(args.db)
+if args.annotation_cache:
+    args.annotation_cache = os.path.abspath(args.annotation_cache)
+if args.enrichment_matrix:
+    args.enrichment_matrix = os.path.abspath(args.enrichment_matrix)
+if args.fa_file:
+    args.fa_file = os.path.abspath(args.fa_file)
+if args.fa_dir:
+    args.fa_dir = os.path.abspath(args.fa_dir)
 
 # initialize logfile
 logging.basicConfig(filename=os.path.join(args.outdir, 'logfile.log'), level=logging.DEBUG)
@@ -140,6 +530,25 @@ logging.info('Changing into %s' % args.db)
 print('Changing into %s' % args.db)
 os.chdir(args.db)
 
+# load once for all the families the correspondences between CDD, COG and COG categories
+# (from the binary index of the reference tables, rebuilt first if they changed)
+cog_reference = None
+if args.cog_enrich:
+    with instrumentation.stage('load_cog_reference') as timer:
+        cog_reference = cog_index.load_cog_reference(os.path.join(script_dir, '../required_files'))
+    msg = '* COG reference tables loaded in %s' % instrumentation.format_duration(timer.elapsed)
+    logging.info(msg)
+    print(msg)
+
+# (an existing enrichment matrix must have the COG letters of the reference
+# tables, checked before any search)
+if args.enrichment_matrix:
+    try:
+        enrichment_matrix.check_letters(args.enrichment_matrix, cog_reference.one_letters)
+    except ValueError as e:
+        logging.critical('* %s' % e)
+        sys.exit('* %s' % e)
+
 # Build the list of paths to fasta
 fasta_files = list()
 if args.fa_file:
@@ -153,11 +562,40 @@ elif args.fa_dir:
 ##########################################
 # RUN RPSBLAST+ & CONVERT CDD TO COG #####
 ##########################################
-for fa in fasta_files:
-    fa_basename = os.path.basename(fa).split(".")[0]
-    run_rpsblast(args, fa, fa_basename)
-    concat_seq_with_no_matches_to_rspblast_out(args, fa, fa_basename, script_dir)
-    if args.cog_enrich:
-        convert_cddid_to_cogid(args, fa_basename, script_dir)
+family_annotators = dict()
+failed_families = list()
+nb_jobs, nb_threads = pipeline_utils.split_thread_budget(args.threads, args.jobs, len(fasta_files))
+if args.annotation_cache:
+    annotate_cached_families(args, fasta_files, cog_reference, args.shards, nb_jobs)
+elif args.pooled:
+    annotate_pooled_families(args, fasta_files, cog_reference, args.shards, nb_jobs)
+elif nb_jobs == 1:
+    for fa in fasta_files:
+        annotate_family(args, fa, cog_reference, nb_threads)
+else:
+    # each worker runs the search of a family and its post-processing, and
+    # then moves on to the next family (the processes do the actual work)
+    msg = 'Annotating %d families, %d at a time with %d thread(s) each' % (len(fasta_files), nb_jobs, nb_threads)
+    logging.info(msg)
+    print(msg)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+        futures = [executor.submit(annotate_family, args, fa, cog_reference, nb_threads) for fa in fasta_files]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
+# add the families to the enrichment matrix
+if args.enrichment_matrix:
+    with instrumentation.stage('update_matrix'):
+        enrichment_matrix.update_matrix(args.enrichment_matrix, family_annotators)
+    msg = '%d families added to the enrichment matrix %s' % (len(family_annotators), args.enrichment_matrix)
+    logging.info(msg)
+    print(msg)
 
+# report the families whose search or annotation failed, and make the run fail
+if failed_families:
+    err = '* the search or the annotation failed for %d families, which were not annotated: %s' % \
+          (len(failed_families), ', '.join(sorted(failed_families)))
+    logging.critical(err)
+instrumentation.finish()
+if failed_families:
+    sys.exit(err)
@@ -0,0 +1,91 @@
+#!/usr/local/bin/python3.5
+
+# Note: this module stores the rpsblast+ hits of sequences in a sqlite
+# database shared by the runs of annotate_gene_family.py (see its
+# --annotation_cache option), so that a sequence recruited by several
+# families, or annotated by a previous run, is searched only once.
+# The hits of a sequence are keyed by the sha256 of the sequence, the
+# database searched and the e-value; sequences without hit are cached too.
+# The least recently used entries are evicted beyond a maximal size.
+
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import pipeline_utils
+
+
+def hash_sequence(sequence):
+    # (case and line breaks of the fasta don't change the hits)
+    return hashlib.sha256(sequence.upper().encode('ascii', errors='replace')).hexdigest()
+
+
+def describe_db(db_dir):
+    # A database is identified by its path and the size and mtime of its files,
+    # so that the hits cached for a previous release of the database are not reused
+    db_dir = os.path.abspath(db_dir)
+    signature = hashlib.sha256(db_dir.encode('utf-8'))
+    for name in sorted(os.listdir(db_dir)):
+        stat = os.stat(os.path.join(db_dir, name))
+        signature.update(('%s\t%d\t%d\n' % (name, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    return signature.hexdigest()
+
+
+class AnnotationCache:
+
+    def __init__(self, cache_path, db_key, e_value, max_size):
+        self.conn = sqlite3.connect(cache_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS hits (seq_hash TEXT, db TEXT, evalue REAL, '
+                          'hits TEXT, size INTEGER, last_used REAL, PRIMARY KEY (seq_hash, db, evalue))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS last_used_idx ON hits (last_used)')
+        self.db_key = db_key
+        self.e_value = e_value
+        self.max_size = max_size
+        self.now = time.time()
+
+    def lookup(self, seq_hashes):
+        # Returns a dictionary seq_hash -> hits (list of the fields of the hits after
+        # the query id) of the cached sequences, and marks them as recently used
+        seq_hashes = list(seq_hashes)
+        found = dict()
+        for batch, placeholders in pipeline_utils.sqlite_batches(seq_hashes):
+            rows = self.conn.execute('SELECT seq_hash, hits FROM hits WHERE db = ? AND evalue = ? AND '
+                                     'seq_hash IN (%s)' % placeholders,
+                                     [self.db_key, self.e_value] + batch)
+            for seq_hash, hits in rows:
+                found[seq_hash] = hits.split('\n') if hits else []
+            self.conn.execute('UPDATE hits SET last_used = ? WHERE db = ? AND evalue = ? AND '
+                              'seq_hash IN (%s)' % placeholders,
+                              [self.now, self.db_key, self.e_value] + batch)
+        self.conn.commit()
+        return found
+
+    def store(self, hits_by_hash):
+        rows = list()
+        for seq_hash, hits in hits_by_hash.items():
+            hits = '\n'.join(hits)
+            rows.append((seq_hash, self.db_key, self.e_value, hits, len(seq_hash) + len(hits), self.now))
+        self.conn.executemany('INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+
+    def evict(self):
+        # Delete the least recently used entries until the cache fits in max_size;
+        # returns the number of entries deleted
+        total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM hits').fetchone()[0]
+        if total_size <= self.max_size:
+            return 0
+        evicted = list()
+        for rowid, size in self.conn.execute('SELECT rowid, size FROM hits ORDER BY last_used'):
+            if total_size <= self.max_size:
+                break
+            evicted.append((rowid,))
+            total_size -= size
+        self.conn.executemany('DELETE FROM hits WHERE rowid = ?', evicted)
+        self.conn.commit()
+        return len(evicted)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,200 @@
+#!/usr/local/bin/python3.5
+
+# Note: this module annotates the rpsblast+ hits of gene families with COG
+# categories, in place of the former awk subscripts left_join_fa_cdd.awk and
+# cdd_2_cog.awk. The reference tables (fun.txt, cddid.tbl and whog) are
+# loaded once per run, then each family is joined and annotated in memory:
+#   * comprehensive rpsblast output: the hits, followed by one empty row
+#     for each sequence of the family without hit
+#   * COG comprehensive output: one row per (hit, COG letter)
+#   * COG enrichment: % of the rows of the comprehensive rpsblast output
+#     associated with each COG letter
+# Files are read and written as latin-1 so that bytes go through untouched.
+
+import re
+
+ENCODING = 'latin-1'
+
+# (letter, supercategory and category of the hits without associated COG)
+NO_COG_LETTER = '[X]'
+NO_COG_SUPERCATEGORY = 'NO COG ASSOCIATED'
+NO_COG_CATEGORY = 'No COG associated'
+
+COMPREHENSIVE_HEADER = '#Seq Id\tCOG Supercategory\tCOG Letter\tCOG Category\tCDD Id\tCDD description\n'
+ENRICHMENT_HEADER = '#COG Letter\tOccurence % in the family of genes\tCOG Supercategory\tCOG Category\n'
+
+SUPERCATEGORY_PATTERN = re.compile(r'^[A-Z]')
+LETTER_PATTERN = re.compile(r' \[[A-Z]\]')
+BLANKS_PATTERN = re.compile(r'[ \t\n]+')
+WHOG_PATTERN = re.compile(r'^\[[A-Z]+\]')
+
+
+def read_lines(path):
+    with open(path, mode='r', encoding=ENCODING, newline='\n') as f:
+        for line in f:
+            yield line.rstrip('\n')
+    f.close()
+
+
+def split_blanks(line):
+    # (fields separated by runs of blanks, as split(line, fields, " ") in awk)
+    return [field for field in BLANKS_PATTERN.split(line) if field]
+
+
+class CogReference:
+    # Correspondences CDD id -> COG id -> COG letters -> COG (super)category
+
+    def __init__(self, fun_path, cddid_path, whog_path):
+        # fun.txt: supercategory lines followed by their " [L] category" lines
+        self.one_letters = [NO_COG_LETTER]
+        self.supercategories = {NO_COG_LETTER: NO_COG_SUPERCATEGORY}
+        self.categories = {NO_COG_LETTER: NO_COG_CATEGORY}
+        curr_supercategory = ''
+        for line in read_lines(fun_path):
+            if SUPERCATEGORY_PATTERN.match(line):
+                curr_supercategory = line
+            if LETTER_PATTERN.search(line):
+                fields = split_blanks(line)
+                self.one_letters.append(fields[0])
+                self.supercategories[fields[0]] = curr_supercategory
+                self.categories[fields[0]] = ' '.join(fields[1:])
+
+        # cddid.tbl: CDD id, accession, short name, description, length
+        self.cdd_cog = dict()
+        self.cdd_descriptions = {'NA': 'NA'}
+        for line in read_lines(cddid_path):
+            fields = line.split('\t')
+            if len(fields) > 1 and fields[1].startswith('COG'):
+                self.cdd_cog[fields[0]] = fields[1]
+                self.cdd_descriptions[fields[0]] = fields[3] if len(fields) > 3 else ''
+
+        # whog: "[LL] COG id description" lines
+        self.cog_letters = {'NA': [NO_COG_LETTER]}
+        for line in read_lines(whog_path):
+            if WHOG_PATTERN.match(line):
+                fields = split_blanks(line) + ['']
+                self.cog_letters[fields[1]] = ['[%s]' % letter for letter in fields[0][1:-1]]
+
+    def annotate(self, cdd):
+        # Returns the rows (supercategory, letter, category, cdd, description)
+        # of a hit; a hit whose COG is missing from whog has no row
+        if not cdd:
+            cdd = 'NA'
+        cog = self.cdd_cog.get(cdd) or 'NA'
+        description = self.cdd_descriptions.get(cdd, '')
+        return [(self.supercategories.get(letter, ''), letter, self.categories.get(letter, ''), cdd, description)
+                for letter in self.cog_letters.get(cog, [])]
+
+
+def read_fasta_ids(fa):
+    # (id is the string between the ">" char and the first space, or another ">")
+    ids = list()
+    for line in read_lines(fa):
+        if line.startswith('>'):
+            ids.append(re.split(r'[> ]', line)[1])
+    return ids
+
+
+def left_join_hits(fasta_ids, hit_lines):
+    # Yields the lines of the hits, then a line for each sequence of the fasta
+    # without hit, made of its id followed by as many tabs as there are fields
+    # in the last line read (as done by left_join_fa_cdd.awk)
+    with_hit = set()
+    nb_fields = None
+    for line in hit_lines:
+        line = line.rstrip('\n')
+        nb_fields = len(line.split('\t')) if line else 0
+        if line.startswith('#'):
+            continue
+        with_hit.add(line.split('\t', 1)[0])
+        yield line
+    if nb_fields is None:
+        # (no hit at all: the last line read was the last line of the fasta)
+        nb_fields = 1
+    no_hit_tabs = '\t' * nb_fields
+    written = set()
+    for seq_id in fasta_ids:
+        if seq_id not in with_hit and seq_id not in written:
+            written.add(seq_id)
+            yield seq_id + no_hit_tabs
+
+
+class FamilyAnnotator:
+    # COG annotation of the rows of the comprehensive rpsblast output of a family,
+    # fed row by row; the comprehensive output is written along the way and the
+    # occurrences of the COG letters are counted for the enrichment
+
+    def __init__(self, reference, comprehensive_out=None):
+        self.reference = reference
+        self.nb_rows = 0
+        self.nb_hits = 0
+        self.occurrences = dict()
+        self.comprehensive_out = None
+        if comprehensive_out:
+            self.comprehensive_out = open(comprehensive_out, mode='w', encoding=ENCODING, newline='\n')
+            self.comprehensive_out.write(COMPREHENSIVE_HEADER)
+
+    def add_row(self, row):
+        fields = row.split('\t')
+        seq_id = fields[0]
+        cdd = fields[1].split('|')[-1] if len(fields) > 1 else ''
+        self.nb_rows += 1
+        if cdd:
+            self.nb_hits += 1
+        for supercategory, letter, category, cdd, description in self.reference.annotate(cdd):
+            if self.comprehensive_out:
+                self.comprehensive_out.write('%s\t%s\t%s\t%s\t%s\t%s\n' %
+                                             (seq_id, supercategory, letter, category, cdd, description))
+            self.occurrences[letter] = self.occurrences.get(letter, 0) + 1
+
+    def enrichment(self):
+        # Returns the rows (letter, %, supercategory, category) of the COG letters
+        rows = list()
+        for letter in self.reference.one_letters:
+            occurrences = self.occurrences.get(letter, 0)
+            percentage = occurrences / self.nb_rows * 100 if occurrences else 0
+            rows.append((letter, percentage, self.reference.supercategories[letter],
+                         self.reference.categories[letter]))
+        return rows
+
+    def finish(self, enrichment_out=None):
+        if self.comprehensive_out:
+            self.comprehensive_out.close()
+            self.comprehensive_out = None
+        if enrichment_out:
+            with open(enrichment_out, mode='w', encoding=ENCODING, newline='\n') as f:
+                f.write(ENRICHMENT_HEADER)
+                for row in self.enrichment():
+                    f.write('%s\t%.2f\t%s\t%s\n' % row)
+            f.close()
+
+
+def annotate_hit_stream(fa, hit_lines, reference=None, comprehensive_rpsblast_out=None,
+                        comprehensive_out=None, enrichment_out=None):
+    # Left join of the fasta with the hits of rpsblast+ (an iterable of lines,
+    # e.g. a pipe) and, if a reference is given, COG annotation of the joined rows
+    # as they come; returns the annotator (or None)
+    annotator = FamilyAnnotator(reference, comprehensive_out) if reference else None
+    out = None
+    if comprehensive_rpsblast_out:
+        out = open(comprehensive_rpsblast_out, mode='w', encoding=ENCODING, newline='\n')
+    for row in left_join_hits(read_fasta_ids(fa), hit_lines):
+        if out:
+            out.write(row + '\n')
+        if annotator:
+            annotator.add_row(row)
+    if out:
+        out.close()
+    if annotator:
+        annotator.finish(enrichment_out)
+    return annotator
+
+
+def annotate_rpsblast_out(fa, rpsblast_out, comprehensive_rpsblast_out, reference=None,
+                          comprehensive_out=None, enrichment_out=None):
+    # (same as annotate_hit_stream, from the output file of rpsblast+)
+    with open(rpsblast_out, mode='r', encoding=ENCODING, newline='\n') as hits:
+        annotator = annotate_hit_stream(fa, hits, reference, comprehensive_rpsblast_out,
+                                        comprehensive_out, enrichment_out)
+    hits.close()
+    return annotator
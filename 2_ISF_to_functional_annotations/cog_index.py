@@ -0,0 +1,216 @@
+#!/usr/local/bin/python3.5
+
+# Note: this script compiles the reference tables of the COG annotation
+# (fun.txt, cddid.tbl and whog, see install.sh) into a binary index that
+# annotate_gene_family.py memory-maps instead of parsing the text files.
+# Layout of the index (little endian):
+#   magic (8 bytes), length of the metadata (uint32), metadata (json)
+#   string table: offsets (uint32, nb_strings + 1), then the strings (latin-1)
+#   CDD records sorted by CDD id: (CDD id, letters, description) as uint32,
+#   letters and description being indexes in the string table
+# The metadata holds the COG letters of fun.txt with their (super)categories,
+# and the size, mtime and sha256 of the source files the index was built from:
+# an index whose sources changed since is rebuilt.
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import cog_annotation
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import pipeline_utils
+
+MAGIC = b'COGIDX1\0'
+INDEX_NAME = 'cog_index.bin'
+SOURCE_NAMES = ['fun.txt', 'cddid.tbl', 'whog']
+RECORD = struct.Struct('<III')
+# (letters of a COG that has no entry in whog: its hits are not annotated)
+NO_LETTERS = 0xFFFFFFFF
+
+
+def describe_sources(required_dir, with_hash=True):
+    sources = dict()
+    for name in SOURCE_NAMES:
+        stat = os.stat(os.path.join(required_dir, name))
+        sources[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': None}
+        if with_hash:
+            sources[name]['sha256'] = pipeline_utils.hash_file(os.path.join(required_dir, name))
+    return sources
+
+
+def is_cdd_number(cdd):
+    # (only the canonical writing of a number matches the CDD id of cddid.tbl)
+    return cdd.isdigit() and str(int(cdd)) == cdd and int(cdd) < NO_LETTERS
+
+
+def build_cog_index(required_dir, index_path):
+    reference = cog_annotation.CogReference(*[os.path.join(required_dir, name) for name in SOURCE_NAMES])
+    strings = dict()
+    records = list()
+    for cdd, cog in reference.cdd_cog.items():
+        if not is_cdd_number(cdd):
+            continue
+        letters = reference.cog_letters.get(cog)
+        if letters is None:
+            letters_idx = NO_LETTERS
+        else:
+            # (letters stored without their brackets, e.g. "EH" for [E][H])
+            letters_idx = strings.setdefault(''.join(letter[1:-1] for letter in letters), len(strings))
+        description_idx = strings.setdefault(reference.cdd_descriptions[cdd], len(strings))
+        records.append((int(cdd), letters_idx, description_idx))
+    records.sort()
+
+    metadata = {'sources': describe_sources(required_dir), 'one_letters': reference.one_letters,
+                'supercategories': reference.supercategories, 'categories': reference.categories,
+                'nb_strings': len(strings), 'nb_records': len(records)}
+    encoded_metadata = json.dumps(metadata).encode('utf-8')
+    # (strings listed by index, as the dict itself keeps no order before python 3.7)
+    encoded_strings = [string.encode(cog_annotation.ENCODING) for string in sorted(strings, key=strings.get)]
+    offsets = [0]
+    for string in encoded_strings:
+        offsets.append(offsets[-1] + len(string))
+
+    # (written to a temporary file first so that a concurrent run never maps a partial index)
+    tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    with open(tmp_path, mode='wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(encoded_metadata)))
+        f.write(encoded_metadata)
+        f.write(struct.pack('<%dI' % len(offsets), *offsets))
+        f.write(b''.join(encoded_strings))
+        for record in records:
+            f.write(RECORD.pack(*record))
+    f.close()
+    os.replace(tmp_path, index_path)
+
+
+class CogIndex:
+    # Read-only access to an index built by build_cog_index, with the
+    # interface of cog_annotation.CogReference used by FamilyAnnotator
+
+    def __init__(self, index_path):
+        with open(index_path, mode='rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a COG index' % index_path)
+        metadata_size = struct.unpack_from('<I', self.buffer, len(MAGIC))[0]
+        offset = len(MAGIC) + 4
+        self.metadata = json.loads(self.buffer[offset:offset + metadata_size].decode('utf-8'))
+        offset += metadata_size
+        self.one_letters = self.metadata['one_letters']
+        self.supercategories = self.metadata['supercategories']
+        self.categories = self.metadata['categories']
+
+        nb_strings = self.metadata['nb_strings']
+        self.offsets_start = offset
+        self.strings_start = offset + 4 * (nb_strings + 1)
+        self.records_start = self.strings_start + struct.unpack_from('<I', self.buffer,
+                                                                     offset + 4 * nb_strings)[0]
+        self.nb_records = self.metadata['nb_records']
+        # (annotations already looked up)
+        self.cache = {'NA': [(cog_annotation.NO_COG_SUPERCATEGORY, cog_annotation.NO_COG_LETTER,
+                              cog_annotation.NO_COG_CATEGORY, 'NA', 'NA')]}
+
+    def string(self, idx):
+        start, end = struct.unpack_from('<II', self.buffer, self.offsets_start + 4 * idx)
+        return self.buffer[self.strings_start + start:self.strings_start + end].decode(cog_annotation.ENCODING)
+
+    def find_record(self, cdd):
+        # binary search of the record of a CDD id
+        low = 0
+        high = self.nb_records
+        while low < high:
+            middle = (low + high) // 2
+            record = RECORD.unpack_from(self.buffer, self.records_start + RECORD.size * middle)
+            if record[0] < cdd:
+                low = middle + 1
+            elif record[0] > cdd:
+                high = middle
+            else:
+                return record
+        return None
+
+    def annotate(self, cdd):
+        if not cdd:
+            cdd = 'NA'
+        if cdd in self.cache:
+            return self.cache[cdd]
+        record = self.find_record(int(cdd)) if is_cdd_number(cdd) else None
+        if record is None:
+            # (CDD without COG: annotated as a hit without associated COG)
+            rows = [(cog_annotation.NO_COG_SUPERCATEGORY, cog_annotation.NO_COG_LETTER,
+                     cog_annotation.NO_COG_CATEGORY, cdd, '')]
+        elif record[1] == NO_LETTERS:
+            rows = []
+        else:
+            description = self.string(record[2])
+            rows = [(self.supercategories.get('[%s]' % letter, ''), '[%s]' % letter,
+                     self.categories.get('[%s]' % letter, ''), cdd, description)
+                    for letter in self.string(record[1])]
+        self.cache[cdd] = rows
+        return rows
+
+    def close(self):
+        self.buffer.close()
+
+
+def is_index_fresh(index_path, required_dir):
+    # The index is fresh if its sources have the size and mtime, or else the
+    # checksum, of the ones it was built from
+    try:
+        index = CogIndex(index_path)
+    except (OSError, ValueError):
+        return False
+    built_from = index.metadata['sources']
+    index.close()
+    current = describe_sources(required_dir, with_hash=False)
+    for name in SOURCE_NAMES:
+        if built_from[name]['size'] != current[name]['size']:
+            return False
+        if built_from[name]['mtime_ns'] != current[name]['mtime_ns'] and \
+                built_from[name]['sha256'] != pipeline_utils.hash_file(os.path.join(required_dir, name)):
+            return False
+    return True
+
+
+def load_cog_reference(required_dir, index_path=None):
+    # Returns the index of the reference tables, (re)built beforehand if it is
+    # missing or stale; falls back to parsing the text files if it can't be built
+    if not index_path:
+        index_path = os.path.join(required_dir, INDEX_NAME)
+    if not is_index_fresh(index_path, required_dir):
+        try:
+            build_cog_index(required_dir, index_path)
+        except OSError:
+            return cog_annotation.CogReference(*[os.path.join(required_dir, name) for name in SOURCE_NAMES])
+    return CogIndex(index_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='This script compiles fun.txt, cddid.tbl and whog into the binary index '
+                    'loaded by annotate_gene_family.py --cog_enrichment')
+    parser.add_argument('-r', '--required_files', dest='required_dir', type=str,
+                        help='specify the path to the directory that contains fun.txt, cddid.tbl and whog '
+                             '(../required_files by default)')
+    parser.add_argument('-o', '--output', dest='index_path', type=str,
+                        help='specify the path to the index to build (%s in the directory of the '
+                             'reference tables by default)' % INDEX_NAME)
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+    if not args.required_dir:
+        args.required_dir = os.path.join(script_dir, '..', 'required_files')
+    if not args.index_path:
+        args.index_path = os.path.join(args.required_dir, INDEX_NAME)
+
+    start_time = time.time()
+    build_cog_index(args.required_dir, args.index_path)
+    print('  * index built in %s: %s' %
+          (time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time)), args.index_path))
+    sys.stdout.flush()
@@ -0,0 +1,312 @@
+#!/usr/local/bin/python3.5
+
+# Note: this script clusters the families of genes by their COG enrichment
+# profiles, in place of the ConsensusClusterPlus step of
+# interactive_enrichment_analysis.R (same defaults: k-means, 500 resamples
+# of 80% of the families, k from 2 to 10). For each resample, k-means is run
+# for every k on the sampled families; the consensus of k is the fraction of
+# the resamples, among those in which two families were both sampled, that
+# put them in the same cluster. The number of clusters is then chosen with
+# the gap statistic, and the families are partitioned by k-means on the
+# complete matrix (as done by the R script).
+# The resamples are spread over a pool of processes, each resample drawing
+# from its own seed (derived from --seed and its index), so that the results
+# don't depend on the number of processes. numpy is required.
+
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import instrumentation
+
+# Maximal number of floats of a block of rows of the consensus matrices
+BLOCK_SIZE = 2**25
+# Number of bins of the cumulative distribution of the consensus values
+NB_CDF_BINS = 100
+# Maximal number of iterations of the k-means of the complete matrix (as in the R script),
+# and of the reference datasets of the gap statistic, so that both are as converged
+FINAL_MAX_ITER = 500
+# (first keys of the seeds of the reference datasets of the gap statistic and of
+# the k-means of the complete matrix, apart from the ones of the resamples)
+REFERENCE_KEY = 10**6
+FINAL_KEY = 2 * 10**6
+
+
+def redirect_msg(msg):
+    print(msg)
+    logging.info(msg)
+    sys.stdout.flush()
+
+
+def load_enrichment_matrix(path):
+    # families x COG letters percentages of annotate_gene_family.py --enrichment_matrix
+    with numpy.load(path, allow_pickle=False) as npz:
+        return [list(npz['families']), list(npz['letters']), npz['percentages'].astype(numpy.float64)]
+
+
+def load_enrichment_files(enrich_dir):
+    # (same matrix, from the <family>COG_enrichment.txt files of annotate_gene_family.py)
+    families = list()
+    letters = None
+    rows = list()
+    for path in sorted(glob.glob(os.path.join(enrich_dir, '*COG_enrichment.txt'))):
+        families.append(os.path.basename(path)[:-len('COG_enrichment.txt')].rstrip('_'))
+        with open(path, mode='r', encoding='latin-1') as f:
+            fields = [line.rstrip('\n').split('\t') for line in f if not line.startswith('#')]
+        f.close()
+        letters = [field[0] for field in fields]
+        rows.append([float(field[1]) for field in fields])
+    return [families, letters, numpy.array(rows, dtype=numpy.float64)]
+
+
+def rep_rng(seed, *keys):
+    # (independent random generator of a resample, a k or a reference dataset)
+    return numpy.random.default_rng(numpy.random.SeedSequence([seed] + list(keys)))
+
+
+def kmeans(data, k, rng, max_iter):
+    # Lloyd's k-means with k-means++ seeding; returns the labels and the
+    # within-cluster sum of squares
+    nb_items = data.shape[0]
+    squared_norms = numpy.einsum('ij,ij->i', data, data)
+    centers = numpy.empty((k, data.shape[1]))
+    centers[0] = data[rng.integers(nb_items)]
+    closest = squared_norms - 2 * data.dot(centers[0]) + centers[0].dot(centers[0])
+    for c in range(1, k):
+        weights = numpy.maximum(closest, 0)
+        total = weights.sum()
+        idx = rng.choice(nb_items, p=weights / total) if total > 0 else rng.integers(nb_items)
+        centers[c] = data[idx]
+        closest = numpy.minimum(closest, squared_norms - 2 * data.dot(centers[c]) + centers[c].dot(centers[c]))
+
+    labels = None
+    for i in range(0, max_iter):
+        distances = squared_norms[:, None] - 2 * data.dot(centers.T) + numpy.einsum('ij,ij->i', centers, centers)
+        new_labels = distances.argmin(axis=1)
+        if labels is not None and numpy.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        sizes = numpy.bincount(labels, minlength=k)
+        sums = numpy.zeros_like(centers)
+        numpy.add.at(sums, labels, data)
+        for c in range(0, k):
+            if sizes[c]:
+                centers[c] = sums[c] / sizes[c]
+            else:
+                # an empty cluster takes the item the farthest from its center
+                farthest = distances[numpy.arange(nb_items), labels].argmax()
+                centers[c] = data[farthest]
+    distances = squared_norms[:, None] - 2 * data.dot(centers.T) + numpy.einsum('ij,ij->i', centers, centers)
+    labels = distances.argmin(axis=1)
+    withinss = numpy.maximum(distances[numpy.arange(nb_items), labels], 0).sum()
+    return [labels, withinss]
+
+
+def resample_worker(job):
+    # k-means of the resamples of a chunk, for each k; returns the labels as an
+    # array (resamples x ks x families), -1 for the families left out
+    data, reps, ks, p_item, seed, max_iter = job
+    nb_items = data.shape[0]
+    nb_sampled = max(1, int(nb_items * p_item))
+    labels = numpy.full((len(reps), len(ks), nb_items), -1, dtype=numpy.int16)
+    for i, rep in enumerate(reps):
+        sampled = numpy.sort(rep_rng(seed, rep).choice(nb_items, nb_sampled, replace=False))
+        for j, k in enumerate(ks):
+            labels[i, j, sampled] = kmeans(data[sampled], min(k, nb_sampled), rep_rng(seed, rep, k), max_iter)[0]
+    return labels
+
+
+def gap_worker(job):
+    # log within-cluster sums of squares of a uniform reference dataset, for each k
+    data, b, ks, seed, max_iter = job
+    rng = rep_rng(seed, REFERENCE_KEY + b)
+    reference = rng.uniform(data.min(axis=0), data.max(axis=0), size=data.shape)
+    return [numpy.log(kmeans(reference, k, rep_rng(seed, REFERENCE_KEY + b, k), max_iter)[1] or 1e-300)
+            for k in ks]
+
+
+def consensus_cdf(labels, k_idx, k, consensus_out=None):
+    # Cumulative distribution of the consensus values of the pairs of families
+    # that were sampled together at least once (upper triangle), computed by
+    # blocks of rows of the count matrices so that they are never held whole,
+    # unless they are written to consensus_out (npz of the numbers of resamples
+    # that clustered together / sampled together each pair of families)
+    nb_reps, nb_ks, nb_items = labels.shape
+    k_labels = labels[:, k_idx, :]
+    sampled = (k_labels >= 0).T.astype(numpy.float32)
+    # one-hot membership (families x (resamples x clusters))
+    membership = numpy.zeros((nb_items, nb_reps * k), dtype=numpy.float32)
+    rows, reps = numpy.nonzero(k_labels.T >= 0)
+    membership[rows, reps * k + k_labels.T[rows, reps]] = 1
+    histogram = numpy.zeros(NB_CDF_BINS, dtype=numpy.int64)
+    if consensus_out:
+        together_counts = numpy.zeros((nb_items, nb_items), dtype=numpy.min_scalar_type(nb_reps))
+        sampled_counts = numpy.zeros((nb_items, nb_items), dtype=numpy.min_scalar_type(nb_reps))
+    block = max(1, BLOCK_SIZE // max(1, nb_items))
+    for start in range(0, nb_items, block):
+        end = min(nb_items, start + block)
+        together = membership[start:end].dot(membership.T)
+        both_sampled = sampled[start:end].dot(sampled.T)
+        if consensus_out:
+            # (float32 products of 0/1 values: exact counts below 2**24)
+            together_counts[start:end] = together
+            sampled_counts[start:end] = both_sampled
+        upper = numpy.triu(numpy.ones((end - start, nb_items), dtype=bool), k=start + 1)
+        upper &= both_sampled > 0
+        values = together[upper] / both_sampled[upper]
+        histogram += numpy.histogram(values, bins=NB_CDF_BINS, range=(0, 1))[0]
+    if consensus_out:
+        numpy.savez_compressed(consensus_out, clustered_together=together_counts, sampled_together=sampled_counts)
+    return numpy.cumsum(histogram) / max(1, histogram.sum())
+
+
+def choose_k(ks, gaps, gap_sds):
+    # smallest k such that gap(k) >= gap(k+1) - sd(k+1)
+    for i in range(0, len(ks) - 1):
+        if gaps[i] >= gaps[i + 1] - gap_sds[i + 1]:
+            return ks[i]
+    return ks[-1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='This script clusters the families of genes by their COG enrichment with consensus '
+                    'k-means clustering, and chooses the number of clusters with the gap statistic')
+    parser.add_argument('-i', '--enrichment_matrix', dest='matrix_path', type=str,
+                        help='specify the path to the enrichment matrix written by '
+                             'annotate_gene_family.py --enrichment_matrix')
+    parser.add_argument('--enrichment_dir', dest='enrich_dir', type=str,
+                        help='(alternative to --enrichment_matrix) specify the path to the directory '
+                             'that stores the *COG_enrichment.txt files of all the families')
+    parser.add_argument('-o', '--output_dir', dest='output_dir', type=str, required=True,
+                        help='specify the path to the output directory')
+    parser.add_argument('--reps', dest='reps', type=int, default=500,
+                        help='specify the number of resamples (500 by default)')
+    parser.add_argument('--p_item', dest='p_item', type=float, default=0.8,
+                        help='specify the fraction of the families drawn by each resample (0.8 by default)')
+    parser.add_argument('--max_k', dest='max_k', type=int, default=10,
+                        help='specify the maximal number of clusters (10 by default)')
+    parser.add_argument('--k', dest='k', type=int,
+                        help='specify the number of clusters of the final partition '
+                             '(chosen with the gap statistic by default)')
+    parser.add_argument('--gap_references', dest='gap_references', type=int, default=20,
+                        help='specify the number of uniform reference datasets of the gap statistic '
+                             '(20 by default)')
+    parser.add_argument('--max_iter', dest='max_iter', type=int, default=10,
+                        help='specify the maximal number of iterations of the k-means of the resamples '
+                             '(10 by default, 500 for the final partition and the gap statistic)')
+    parser.add_argument('--consensus_matrices', dest='consensus_matrices', action='store_true',
+                        help='(optional) write the consensus matrix of each k (consensus_k<k>.npz, '
+                             'families x families counts: beware of their size with many families)')
+    parser.add_argument('--processes', dest='processes', type=int, default=1,
+                        help='specify the number of processes running the resamples; the results '
+                             'do not depend on it (1 by default)')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='specify the seed of the random generators (0 by default)')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.start(args)
+
+    ##########################################
+    # SETUP ##################################
+    ##########################################
+    if numpy is None:
+        sys.exit("numpy is required by consensus_clustering.py")
+    args.output_dir = os.path.abspath(args.output_dir)
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    logging.basicConfig(filename=os.path.join(args.output_dir, 'consensus_clustering.log'), level=logging.DEBUG)
+
+    if args.matrix_path:
+        families, letters, data = load_enrichment_matrix(args.matrix_path)
+    elif args.enrich_dir:
+        families, letters, data = load_enrichment_files(args.enrich_dir)
+    else:
+        sys.exit("--enrichment_matrix or --enrichment_dir is required")
+    ks = list(range(2, min(args.max_k, len(families)) + 1))
+    if not ks:
+        sys.exit("at least 2 families are required")
+    redirect_msg("  * %d families x %d COG letters, k from %d to %d" % (len(families), len(letters), ks[0], ks[-1]))
+
+    ##########################################
+    # RESAMPLING #############################
+    ##########################################
+    resampling_timer = instrumentation.stage('resampling').start()
+    nb_chunks = max(1, min(args.reps, 4 * args.processes))
+    chunks = [list(range(args.reps))[i::nb_chunks] for i in range(0, nb_chunks)]
+    resample_jobs = [(data, reps, ks, args.p_item, args.seed, args.max_iter) for reps in chunks]
+    gap_jobs = [(data, b, [1] + ks, args.seed, FINAL_MAX_ITER) for b in range(0, args.gap_references)]
+    if args.processes > 1:
+        pool = multiprocessing.get_context('fork').Pool(args.processes)
+        chunk_labels = pool.map(resample_worker, resample_jobs)
+        reference_log_withinss = pool.map(gap_worker, gap_jobs)
+        pool.close()
+        pool.join()
+    else:
+        chunk_labels = [resample_worker(job) for job in resample_jobs]
+        reference_log_withinss = [gap_worker(job) for job in gap_jobs]
+    # (resamples put back in their order, whatever the chunks)
+    labels = numpy.empty((args.reps, len(ks), len(families)), dtype=numpy.int16)
+    for reps, curr_labels in zip(chunks, chunk_labels):
+        labels[reps] = curr_labels
+    redirect_msg("  * %d resamples clustered in %s" %
+                 (args.reps, instrumentation.format_duration(resampling_timer.stop())))
+    instrumentation.count('families', len(families))
+    instrumentation.count('resamples', args.reps)
+
+    ##########################################
+    # CONSENSUS & GAP STATISTIC ##############
+    ##########################################
+    consensus_timer = instrumentation.stage('consensus').start()
+    summary = list()
+    previous_area = None
+    for k_idx, k in enumerate(ks):
+        consensus_out = None
+        if args.consensus_matrices:
+            consensus_out = os.path.join(args.output_dir, 'consensus_k%d.npz' % k)
+        cdf = consensus_cdf(labels, k_idx, k, consensus_out)
+        area = cdf.sum() / NB_CDF_BINS
+        delta_area = area if previous_area is None else (area - previous_area) / previous_area
+        previous_area = area
+        summary.append([k, area, delta_area])
+
+    consensus_timer.stop()
+
+    gap_timer = instrumentation.stage('gap_statistic').start()
+    gap_ks = [1] + ks
+    log_withinss = [numpy.log(kmeans(data, k, rep_rng(args.seed, FINAL_KEY, k), FINAL_MAX_ITER)[1] or 1e-300)
+                    for k in gap_ks]
+    reference_log_withinss = numpy.array(reference_log_withinss)
+    gaps = reference_log_withinss.mean(axis=0) - numpy.array(log_withinss)
+    gap_sds = reference_log_withinss.std(axis=0) * numpy.sqrt(1 + 1 / max(1, args.gap_references))
+    best_k = args.k if args.k else choose_k(gap_ks, gaps, gap_sds)
+    gap_timer.stop()
+    redirect_msg("  * number of clusters: %d%s" % (best_k, '' if args.k else ' (gap statistic)'))
+
+    ##########################################
+    # OUTPUT #################################
+    ##########################################
+    with open(os.path.join(args.output_dir, 'consensus_summary.tsv'), mode='w') as f:
+        f.write('#k\tcdf_area\tdelta_area\tgap\tgap_sd\n')
+        f.write('1\tNA\tNA\t%.6f\t%.6f\n' % (gaps[0], gap_sds[0]))
+        for i, (k, area, delta_area) in enumerate(summary):
+            f.write('%d\t%.6f\t%.6f\t%.6f\t%.6f\n' % (k, area, delta_area, gaps[i + 1], gap_sds[i + 1]))
+    f.close()
+
+    partition = kmeans(data, best_k, rep_rng(args.seed, FINAL_KEY, best_k), FINAL_MAX_ITER)[0]
+    with open(os.path.join(args.output_dir, 'partition.tsv'), mode='w') as f:
+        f.write('#family\tcluster\n')
+        for family, cluster in zip(families, partition):
+            f.write('%s\t%d\n' % (family, cluster + 1))
+    f.close()
+    redirect_msg("  * outputs written in %s" % args.output_dir)
+    instrumentation.finish()
@@ -0,0 +1,73 @@
+#!/usr/local/bin/python3.5
+
+# Note: this module stores the COG enrichment of many families as one
+# families x COG letters matrix (compressed npz, see the --enrichment_matrix
+# option of annotate_gene_family.py), instead of one text file per family:
+#   families                  name of each family (rows)
+#   letters, supercategories, COG letters (columns) and their labels
+#   categories
+#   counts                    occurrences of each letter in each family (int64)
+#   totals                    number of annotated rows of each family (int64)
+#   percentages               counts / totals * 100, not rounded (float64)
+# A matrix is updated in place: the rows of the families annotated again are
+# replaced and the rows of the new families are appended. A matrix whose COG
+# letters differ from the ones of the reference tables is never updated.
+# numpy is required by this module.
+
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def load_matrix(path):
+    # Returns the arrays of a matrix written by update_matrix as a dictionary
+    with numpy.load(path, allow_pickle=False) as npz:
+        return dict((name, npz[name]) for name in npz.files)
+
+
+def check_letters(path, letters):
+    # Raises a ValueError if the matrix at path exists with other COG letters
+    # (its rows could not be merged with the ones annotated from letters)
+    if os.path.isfile(path):
+        previous_letters = list(load_matrix(path)['letters'])
+        if previous_letters != list(letters):
+            raise ValueError('the COG letters of the enrichment matrix %s (%s) differ from the ones of '
+                             'the reference tables (%s), remove it or choose another path to rebuild it' %
+                             (path, ''.join(previous_letters), ''.join(letters)))
+
+
+def update_matrix(path, annotators):
+    # annotators: dictionary family -> cog_annotation.FamilyAnnotator (finished)
+    if not annotators:
+        return
+    reference = next(iter(annotators.values())).reference
+    letters = list(reference.one_letters)
+    families = sorted(annotators)
+    counts = numpy.array([[annotators[family].occurrences.get(letter, 0) for letter in letters]
+                          for family in families], dtype=numpy.int64)
+    totals = numpy.array([annotators[family].nb_rows for family in families], dtype=numpy.int64)
+
+    if os.path.isfile(path):
+        check_letters(path, letters)
+        previous = load_matrix(path)
+        # keep the rows of the families that were not annotated again
+        kept = numpy.array([family not in annotators for family in previous['families']], dtype=bool)
+        families = list(previous['families'][kept]) + families
+        counts = numpy.concatenate([previous['counts'][kept], counts])
+        totals = numpy.concatenate([previous['totals'][kept], totals])
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        percentages = numpy.where(totals[:, None] > 0, counts / totals[:, None] * 100, 0.0)
+    supercategories = [reference.supercategories[letter] for letter in letters]
+    categories = [reference.categories[letter] for letter in letters]
+    # (written to a temporary file first, as numpy appends .npz to names without it)
+    tmp_path = path + '.tmp.npz'
+    numpy.savez_compressed(tmp_path, families=numpy.array(families, dtype=str),
+                           letters=numpy.array(letters, dtype=str),
+                           supercategories=numpy.array(supercategories, dtype=str),
+                           categories=numpy.array(categories, dtype=str),
+                           counts=counts, totals=totals, percentages=percentages)
+    os.replace(tmp_path, path)
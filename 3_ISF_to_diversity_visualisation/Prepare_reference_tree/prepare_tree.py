@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 # import pandas
 # import re
 from ete3 import *
 import subprocess
 import argparse
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'common'))
+import instrumentation
 ncbi = NCBITaxa()
 
+# Number of taxonomic ids or names per query to the local NCBI taxonomy
+TAXONOMY_BATCH_SIZE = 5000
+
 
 def create_output_dir(tree_path):
     # Creates an output directory one directory ahead of tree_path
@@ -33,76 +40,142 @@ def convert_itol_to_nhx(tree_path):
 
 
 def name_internal_nodes(node, k):
-    if not node.is_leaf():
-        node.name = "Node_" + str(k)
-        k += 1
-        children = node.get_children()
-        for i in range(0, len(children)):
-            k = name_internal_nodes(children[i], k)
+    # Names the internal nodes Node_<k>, k increasing in preorder, and returns
+    # the next k (traversal with an explicit stack, so that the deepest trees
+    # don't exceed the recursion limit)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if not node.is_leaf():
+            node.name = "Node_" + str(k)
+            k += 1
+            stack.extend(reversed(node.children))
     return k
 
 
+def query_by_batches(query, items):
+    # One query to the taxonomy database per batch of items; a batch that is
+    # rejected (e.g. a name with quotes) is queried item by item, the items
+    # that fail being left out
+    results = dict()
+    for i in range(0, len(items), TAXONOMY_BATCH_SIZE):
+        batch = items[i:i + TAXONOMY_BATCH_SIZE]
+        try:
+            results.update(query(batch))
+        except Exception:
+            for item in batch:
+                try:
+                    results.update(query([item]))
+                except Exception:
+                    pass
+    return results
+
+
 def read_node_dict(dict_path):
-    # Associate to each node name, its corresponding taxonomic attributes
-    tree_dict = dict()
-    tree_dict['species'] = dict()
-    tree_dict['taxid'] = dict()
-    tree_dict['lineage'] = dict()
-    tree_dict['rank'] = dict()
+    # Associate to each node name, its corresponding taxonomic attributes.
+    # The taxa of all the rows are resolved at once: the taxonomic ids and the
+    # species names are translated, then their lineages are fetched, and the
+    # ranks of the union of the lineages, each step in a few batched queries
+    rows = list()
     with open(dict_path, "r") as input_file:
         # Skip header
         next(input_file)
         for row in input_file:
             row_fields = row.split("\t")
-            node_name = row_fields[0]
-            taxon = row_fields[1].strip()
-            try:
-                # if taxon is an integer, then it might be a taxonomic id
-                int(taxon)
-                try:
-                    # if species entry is indeed a taxonomic id
-                    # use it to retrieve the species name
-                    tree_dict['species'][node_name] = list(ncbi.get_taxid_translator([taxon]).values())[0]
-                    tree_dict['taxid'][node_name] = taxon
-                except:
-                    tree_dict['species'][node_name] = 'NA'
-                    tree_dict['taxid'][node_name] = 'NA'
-            except:
-                # if taxon is a string, then it might be a species name
-                try:
-                    translated_name = list(ncbi.get_name_translator([taxon]).values())
-                    tree_dict['species'][node_name] = taxon
-                    tree_dict['taxid'][node_name] = (translated_name[0][0])
-                except:
-                    tree_dict['species'][node_name] = 'NA'
-                    tree_dict['taxid'][node_name] = 'NA'
-            # Use tax id to retrieve lineage and ranks
-            if tree_dict['taxid'][node_name] != 'NA':
-                tree_dict['lineage'][node_name] = ncbi.get_lineage(tree_dict['taxid'][node_name])
-                tree_dict['rank'][node_name] = ncbi.get_rank(tree_dict['lineage'][node_name])
-            else:
-                tree_dict['lineage'][node_name] = ['NA']
-                tree_dict['rank'][node_name] = [{'NA': 'NA'}]
+            rows.append([row_fields[0], row_fields[1].strip()])
     input_file.close()
+
+    # if taxon is an integer, then it might be a taxonomic id,
+    # otherwise it might be a species name
+    taxon_ids = dict()
+    taxon_names = set()
+    for node_name, taxon in rows:
+        try:
+            taxon_ids[taxon] = int(taxon)
+        except ValueError:
+            taxon_names.add(taxon)
+    taxid2species = query_by_batches(ncbi.get_taxid_translator, sorted(set(taxon_ids.values())))
+    # (names are matched regardless of their case, as by the taxonomy database)
+    name2taxids = dict((name.lower(), taxids) for name, taxids in
+                       query_by_batches(ncbi.get_name_translator, sorted(taxon_names)).items())
+
+    node_species = dict()
+    node_taxid = dict()
+    for node_name, taxon in rows:
+        node_species[node_name] = 'NA'
+        node_taxid[node_name] = 'NA'
+        if taxon in taxon_ids:
+            # (the taxonomic id is kept as written in the dictionary)
+            if taxon_ids[taxon] in taxid2species:
+                node_species[node_name] = taxid2species[taxon_ids[taxon]]
+                node_taxid[node_name] = taxon
+        elif name2taxids.get(taxon.lower()):
+            node_species[node_name] = taxon
+            node_taxid[node_name] = name2taxids[taxon.lower()][0]
+
+    # Use tax ids to retrieve lineages and ranks
+    taxids = sorted(set(int(taxid) for taxid in node_taxid.values() if taxid != 'NA'))
+    lineages = query_by_batches(ncbi.get_lineage_translator, taxids)
+    for taxid in taxids:
+        if taxid not in lineages:
+            # (e.g. a merged taxonomic id, only translated by get_lineage)
+            try:
+                lineages[taxid] = ncbi.get_lineage(taxid)
+            except ValueError:
+                pass
+    ranks = query_by_batches(ncbi.get_rank, sorted(set(t for lineage in lineages.values() for t in lineage)))
+
+    tree_dict = dict()
+    tree_dict['species'] = node_species
+    tree_dict['taxid'] = node_taxid
+    tree_dict['lineage'] = dict()
+    tree_dict['rank'] = dict()
+    for node_name in node_taxid:
+        lineage = lineages.get(int(node_taxid[node_name])) if node_taxid[node_name] != 'NA' else None
+        if lineage:
+            tree_dict['lineage'][node_name] = lineage
+            tree_dict['rank'][node_name] = dict((t, ranks[t]) for t in lineage if t in ranks)
+        else:
+            tree_dict['lineage'][node_name] = ['NA']
+            tree_dict['rank'][node_name] = [{'NA': 'NA'}]
     return tree_dict
 
 
 def assign_br_avg_length(node, nb_attached_leaves, parent_dist):
-    sum_distance_to_leaves = 0
-    if node.is_leaf():
-        nb_attached_leaves += 1
-        sum_distance_to_leaves += node.dist + parent_dist
-        node.br_avg_length = 0
-    else:
-        children = node.get_children()
-        parent_dist += node.dist
-        for i in range(0, len(children)):
-            [curr_nb_attached_leaves, curr_sum_distance_to_leaves] = \
-                assign_br_avg_length(children[i], 0, parent_dist)
-            nb_attached_leaves += curr_nb_attached_leaves
-            sum_distance_to_leaves += curr_sum_distance_to_leaves
-        node.br_avg_length = (sum_distance_to_leaves - nb_attached_leaves * parent_dist) / nb_attached_leaves
-    return [nb_attached_leaves, sum_distance_to_leaves]
+    # Assigns to each internal node the average length of the branches that
+    # separate it from its leaves (0 to the leaves), and returns the number of
+    # leaves of node and the sum of their distances to the root. The distances
+    # to the root are computed in preorder, then the sums of the leaves are
+    # gathered in postorder (reversed preorder), without recursion
+    preorder = list()
+    stack = [[node, parent_dist]]
+    while stack:
+        curr_node, curr_parent_dist = stack.pop()
+        preorder.append([curr_node, curr_parent_dist])
+        if not curr_node.is_leaf():
+            curr_parent_dist += curr_node.dist
+            stack.extend([child, curr_parent_dist] for child in reversed(curr_node.children))
+
+    # (number of leaves and sum of their distances, by id of the visited nodes
+    # whose parent was not visited yet)
+    leaves = dict()
+    for curr_node, curr_parent_dist in reversed(preorder):
+        curr_nb_attached_leaves = nb_attached_leaves if curr_node is node else 0
+        sum_distance_to_leaves = 0
+        if curr_node.is_leaf():
+            curr_nb_attached_leaves += 1
+            sum_distance_to_leaves += curr_node.dist + curr_parent_dist
+            curr_node.br_avg_length = 0
+        else:
+            curr_parent_dist += curr_node.dist
+            for child in curr_node.children:
+                [child_nb_attached_leaves, child_sum_distance_to_leaves] = leaves.pop(id(child))
+                curr_nb_attached_leaves += child_nb_attached_leaves
+                sum_distance_to_leaves += child_sum_distance_to_leaves
+            curr_node.br_avg_length = (sum_distance_to_leaves - curr_nb_attached_leaves * curr_parent_dist) / \
+                curr_nb_attached_leaves
+        leaves[id(curr_node)] = [curr_nb_attached_leaves, sum_distance_to_leaves]
+    return leaves[id(node)]
 
 
 def toto(tree):
@@ -117,13 +190,16 @@ def toto(tree):
 
 
 def collapse_by_br_length(node, cutoff, nodes_to_collapse):
-    if not node.is_leaf():
-        if node.br_avg_length < cutoff:
-            nodes_to_collapse.append(node.name)
-        else:
-            children = node.get_children()
-            for i in range(0, len(children)):
-                collapse_by_br_length(children[i], cutoff, nodes_to_collapse)
+    # Lists in preorder the highest internal nodes whose average branch length
+    # is below the cutoff (traversal with an explicit stack)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if not node.is_leaf():
+            if node.br_avg_length < cutoff:
+                nodes_to_collapse.append(node.name)
+            else:
+                stack.extend(reversed(node.children))
 
 
 ##################################################################
@@ -145,26 +221,35 @@ parser.add_argument('--length_cutoff', dest="length_cutoff", type=float,
 parser.add_argument('--rank_to_deduplicate', dest="rank_cutoff", type=float, default = "phylum",
                     help='specify the taxonomic rank to consider to collapse nodes if '
                          '--collapse_method has been set to "rank deduplication" ("phylum" by default)')
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.start(args)
 
 
 # SETUP
-output_dir = create_output_dir(os.path.abspath(args.tree))
-nhx_tree = convert_itol_to_nhx(args.tree)
-tree = Tree(nhx_tree, format=1)
-name_internal_nodes(tree, 0)
+output_dir = create_output_dir(os.path.abspath(args.input_tree))
+with instrumentation.stage('read_tree'):
+    nhx_tree = convert_itol_to_nhx(args.input_tree)
+    tree = Tree(nhx_tree, format=1)
+with instrumentation.stage('name_internal_nodes'):
+    instrumentation.count('internal_nodes', name_internal_nodes(tree, 0))
 tree.write(features=['name'], format=1, outfile=os.path.join(output_dir, "with_internal_nodes.txt"))
-tree_dict = read_node_dict(args.tree_dict)
+with instrumentation.stage('read_node_dict'):
+    tree_dict = read_node_dict(args.tree_dict)
+instrumentation.count('dictionary_nodes', len(tree_dict['taxid']))
+instrumentation.count('taxa_resolved', len([taxid for taxid in tree_dict['taxid'].values() if taxid != 'NA']))
 method_recognized = False
 
 # COLLAPSE BRANCHES BY AVG LENGTH
 if args.collapse == "branch avg length":
     method_recognized = True
     if args.length_cutoff:
-        tree.br_avg_length = 0
-        assign_br_avg_length(tree, 0, -tree.dist)
-        nodes_to_collapse = list()
-        collapse_by_br_length(tree, args.length_cutoff, nodes_to_collapse)
+        with instrumentation.stage('collapse_by_br_length'):
+            tree.br_avg_length = 0
+            assign_br_avg_length(tree, 0, -tree.dist)
+            nodes_to_collapse = list()
+            collapse_by_br_length(tree, args.length_cutoff, nodes_to_collapse)
+        instrumentation.count('nodes_to_collapse', len(nodes_to_collapse))
     else:
         sys.exit()
 
@@ -173,6 +258,8 @@ with open(os.path.join(output_dir, 'collapse.txt'), "w") as f:
         f.write("%s\n" % nodes_to_collapse[i])
     f.close()
 
+instrumentation.finish()
+
 
 # ############################################################
 # # INPUT FILE 1: taxonomic attributes of nodes ##############
@@ -2,10 +2,14 @@
 
 import argparse
 import os
+import sys
 from glob import glob
 from ete3 import *
 import numpy as np
 import pandas as pd
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import instrumentation
 
 ncbi = NCBITaxa()
 
@@ -185,17 +189,22 @@ parser.add_argument('-o', '--output_dir', dest='output_dir', type=str,
 parser.add_argument('-t', '--reference_tree', dest='tree', type=str,
                     help='specify that path to a reference phylogenetic tree in Newick format'
                          '(each leaf must have a "taxon" attribute corresponding to its NCBI taxonomic id)')
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.start(args)
 if not os.path.exists(args.output_dir):
     os.makedirs(args.output_dir)
 
 # LOAD EDGES FILES
 list_edges_files = glob(os.path.join(args.input_dir, '*MultiTwin_edges.csv'))
-family_dict = load_tax_info_of_families(list_edges_files)
+with instrumentation.stage('load_families'):
+    family_dict = load_tax_info_of_families(list_edges_files)
 family_names = list(family_dict['taxon'])
+instrumentation.count('families', len(family_names))
 
 
 # LOAD REFERENCE TREE
+tree_timer = instrumentation.stage('load_reference_tree').start()
 tree = Tree(args.tree, format=1)
 tree_leaves, tree_names, tree_taxons = load_leaves_entries_of_tree(tree)
 tree_dict = dict()
@@ -204,6 +213,8 @@ tree_dict['name'], tree_dict['taxon'] = \
 tree_dict['lineage'], tree_dict['ranks'] = \
     species_taxons_to_tax_info(tree_dict['taxon'])
 taxon_to_leaves_dict = taxon_to_leaves(tree_leaves, tree_dict['lineage'])
+tree_timer.stop()
+instrumentation.count('tree_leaves', len(tree_leaves))
 
 
 # FIND BEST LEAVES TO ANCHOR EACH SPECIES OF A
@@ -211,8 +222,9 @@ taxon_to_leaves_dict = taxon_to_leaves(tree_leaves, tree_dict['lineage'])
 # Initialize matrix of count
 hist_df = pd.DataFrame(np.zeros((len(tree_leaves)+1, len(family_names))),
                        columns=family_names, index=tree_names + ['UNANCHORED'])
-hist_df, matched_leaves, unanchored_taxons = \
-    find_best_matches(family_dict, taxon_to_leaves_dict, hist_df)
+with instrumentation.stage('find_best_matches'):
+    hist_df, matched_leaves, unanchored_taxons = \
+        find_best_matches(family_dict, taxon_to_leaves_dict, hist_df)
 
 
 # INFER AGE OF THE FAMILY WITH DOLLO PARCIMONY
@@ -225,3 +237,5 @@ common_ancestor = tree.get_common_ancestor(unique_leaves)
 hist_df = np.floor(hist_df)
 hist_df.to_csv(path_or_buf=os.path.join(args.output_dir, "hist_mat.csv"),
                sep=",", header=True, index=True)
+
+instrumentation.finish()
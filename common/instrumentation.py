@@ -0,0 +1,159 @@
+#!/usr/local/bin/python3.5
+
+# Note: this module instruments the scripts of the pipeline with:
+#   * stage timers: wall-clock time and number of calls of each stage of a
+#     run, cumulated over its calls (e.g. over the families)
+#   * counters of the items processed (sequences, hits, species...)
+#   * a JSON report of the timers and counters of the run (--timing_report)
+#   * optionally, the cProfile statistics of the run (--profile), and the peak
+#     and main allocation sites of its memory traced by tracemalloc (--trace_memory)
+# A script adds the options with add_arguments, calls start(args) once they are
+# parsed and finish() at its end. Timers and counters may be updated from
+# several threads; the ones of worker processes are not gathered.
+# The scripts import this module by adding the common directory of the
+# repository to sys.path.
+
+import collections
+import cProfile
+import datetime
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# Number of functions listed in the text summary of the profile
+NB_PROFILE_LINES = 40
+# Number of allocation sites listed in the report of the traced memory
+NB_MEMORY_SITES = 10
+
+# state of the run (stages and counters in the order of their first update)
+stages = collections.OrderedDict()
+counters = collections.OrderedDict()
+lock = threading.Lock()
+run = {'args': None, 'started': None, 'start_time': None, 'profiler': None}
+
+
+def format_duration(seconds):
+    return time.strftime("%H:%M:%S", time.gmtime(seconds))
+
+
+class Stage:
+    # Timer of a stage, used as a context manager or through start() and stop();
+    # its duration is kept in elapsed once it ends
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.start_time
+        with lock:
+            curr_stage = stages.setdefault(self.name, {'calls': 0, 'wall_time_s': 0.0})
+            curr_stage['calls'] += 1
+            curr_stage['wall_time_s'] += self.elapsed
+        return self.elapsed
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+def stage(name):
+    return Stage(name)
+
+
+def count(name, nb=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + nb
+
+
+def add_arguments(parser):
+    parser.add_argument('--timing_report', dest='timing_report', type=str,
+                        help='specify the path to a JSON report of the time spent in each stage of '
+                             'the run and of the numbers of items processed (optional)')
+    parser.add_argument('--profile', dest='profile', type=str,
+                        help='specify the path to the cProfile statistics of the run (readable with '
+                             'python -m pstats), summarized in <path>.txt; only the main thread is '
+                             'profiled (optional)')
+    parser.add_argument('--trace_memory', dest='trace_memory', action='store_true', default=False,
+                        help='whether to trace the memory allocations of the run with tracemalloc and '
+                             'report their peak and main sites, at the cost of a slower run (optional)')
+
+
+def start(args):
+    # (paths made absolute as some scripts change their working directory)
+    if args.timing_report:
+        args.timing_report = os.path.abspath(args.timing_report)
+    if args.profile:
+        args.profile = os.path.abspath(args.profile)
+    run['args'] = args
+    run['started'] = datetime.datetime.now().isoformat()
+    run['start_time'] = time.perf_counter()
+    if args.trace_memory:
+        tracemalloc.start()
+    if args.profile:
+        run['profiler'] = cProfile.Profile()
+        run['profiler'].enable()
+
+
+def memory_report():
+    current, peak = tracemalloc.get_traced_memory()
+    sites = tracemalloc.take_snapshot().statistics('lineno')[:NB_MEMORY_SITES]
+    tracemalloc.stop()
+    return {'current_bytes': current, 'peak_bytes': peak,
+            'top_sites': [{'site': str(site.traceback), 'size_bytes': site.size, 'count': site.count}
+                          for site in sites]}
+
+
+def finish():
+    # Stops the profiling and the tracing of the memory, and writes their
+    # outputs and the timing report; returns the report
+    args = run['args']
+    if run['profiler']:
+        run['profiler'].disable()
+        run['profiler'].dump_stats(args.profile)
+        with open(args.profile + '.txt', mode='w') as f:
+            pstats.Stats(run['profiler'], stream=f).sort_stats('cumulative').print_stats(NB_PROFILE_LINES)
+        f.close()
+        run['profiler'] = None
+
+    cpu_times = os.times()
+    report = collections.OrderedDict()
+    report['script'] = os.path.basename(sys.argv[0])
+    report['argv'] = sys.argv[1:]
+    report['started'] = run['started']
+    report['wall_time_s'] = round(time.perf_counter() - run['start_time'], 6)
+    # (the children are the subprocesses waited for, e.g. rpsblast+ or ISF)
+    report['cpu_time_s'] = {'user': cpu_times[0], 'system': cpu_times[1],
+                            'children_user': cpu_times[2], 'children_system': cpu_times[3]}
+    with lock:
+        report['stages'] = collections.OrderedDict(
+            (name, {'calls': curr_stage['calls'], 'wall_time_s': round(curr_stage['wall_time_s'], 6)})
+            for name, curr_stage in stages.items())
+        report['counters'] = collections.OrderedDict(counters)
+    if args.trace_memory and tracemalloc.is_tracing():
+        report['memory'] = memory_report()
+    if args.profile:
+        report['profile'] = args.profile
+
+    for name, curr_stage in report['stages'].items():
+        logging.info('* stage %s: %d call(s) in %s' %
+                     (name, curr_stage['calls'], format_duration(curr_stage['wall_time_s'])))
+    if args.timing_report:
+        with open(args.timing_report, mode='w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        f.close()
+    return report
@@ -0,0 +1,40 @@
+#!/usr/local/bin/python3.5
+
+# Note: this module holds the helpers shared by several stages of the
+# pipeline, so that they are written once:
+#   * the sha256 of the input files (seeds, target databases, reference tables)
+#   * the split of a global thread budget between concurrent jobs
+#   * the batches of keys of the "IN (...)" queries of the sqlite indexes
+# The scripts import this module by adding the common directory of the
+# repository to sys.path.
+
+import hashlib
+
+# Number of keys per sqlite query (below the default limit of
+# 999 host parameters of older sqlite versions)
+SQLITE_BATCH_SIZE = 900
+
+
+def hash_file(path, block_size=2**20):
+    sha = hashlib.sha256()
+    with open(path, mode='rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    f.close()
+    return sha.hexdigest()
+
+
+def split_thread_budget(nb_threads, nb_jobs, nb_tasks):
+    # Never run more jobs than there are tasks or threads, so that every
+    # job gets at least one thread of the global budget; returns the
+    # number of jobs and the number of threads of each job
+    nb_jobs = max(1, min(nb_jobs, nb_threads, nb_tasks))
+    return [nb_jobs, max(1, nb_threads // nb_jobs)]
+
+
+def sqlite_batches(keys):
+    # Yields the batches of keys of at most SQLITE_BATCH_SIZE keys, each one
+    # with the placeholders of its "IN (...)" clause
+    for i in range(0, len(keys), SQLITE_BATCH_SIZE):
+        batch = keys[i:i + SQLITE_BATCH_SIZE]
+        yield [batch, ','.join('?' * len(batch))]
@@ -77,6 +77,9 @@ gunzip cddid.tbl.gz
 wget -q ftp://ftp.ncbi.nlm.nih.gov/pub/COG/COG/fun.txt
 wget -q ftp://ftp.ncbi.nlm.nih.gov/pub/COG/COG/whog
 
+# compile cddid, fun and whog into the index loaded by annotate_gene_family.py
+python3 "$ISF_ADDONS_DIR"/2_ISF_to_functional_annotations/cog_index.py -r "$ISF_ADDONS_DIR"/required_files
+
 cd ../
 
 chmod -r ugo+rwx "$ISF_ADDONS_DIR";
\ No newline at end of file
@@ -6,6 +6,9 @@ import re
 import os
 import subprocess
 import tempfile
+# (shared modules of the pipeline, in the common directory of the repository)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'common'))
+import instrumentation
 
 
 def get_fasta_ids(fasta):
@@ -26,6 +29,13 @@ def write_ids(ids, output_file):
     f.close()
 
 
+def count_lines(path):
+    with open(path, mode="r") as f:
+        nb_lines = sum(1 for line in f)
+    f.close()
+    return nb_lines
+
+
 def get_remote_seqs_from_iteration1(ids, edge_file, output_file):
     f = open(output_file, mode="w")
     for id in ids:
@@ -50,17 +60,27 @@ parser.add_argument('-o', dest='output_dir', type=str,
                     help='specify the path to the output directory')
 parser.add_argument('-t', dest='pident_thr', type=str,
                     help='pourcentage_identity_threshold')
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.start(args)
 
 if not os.path.exists(args.output_dir):
     os.makedirs(args.output_dir)
 
-ids = get_fasta_ids(args.family_file)
-query_ids_file = os.path.join(args.output_dir, "query_ids.txt")
-write_ids(ids, query_ids_file)
+with instrumentation.stage('read_query_ids'):
+    ids = get_fasta_ids(args.family_file)
+    query_ids_file = os.path.join(args.output_dir, "query_ids.txt")
+    write_ids(ids, query_ids_file)
+instrumentation.count('query_ids', len(ids))
 
 edges_it1_file = os.path.join(args.output_dir, "edges_first_iteration.tsv")
-get_remote_seqs_from_iteration1(ids, args.edge_file, edges_it1_file)
+with instrumentation.stage('extract_edges'):
+    get_remote_seqs_from_iteration1(ids, args.edge_file, edges_it1_file)
+instrumentation.count('edges_first_iteration', count_lines(edges_it1_file))
 
 filt_edges_file = os.path.join(args.output_dir, "filtered_edges_first_iteration.tsv")
-filter_edges(edges_it1_file, query_ids_file, filt_edges_file, args.pident_thr)
+with instrumentation.stage('filter_edges'):
+    filter_edges(edges_it1_file, query_ids_file, filt_edges_file, args.pident_thr)
+instrumentation.count('filtered_edges', count_lines(filt_edges_file))
+
+instrumentation.finish()